@@ -0,0 +1,439 @@
+"""Image analysis for the biosensor scans"""
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+from time import perf_counter
+
+import numpy as np
+
+from BioTiff import imread
+from BioStorage import ScanStack, ScanContainer
+
+
+def _runs(mask):
+    """Returns (start, stop) of each run of True in a 1D mask"""
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def find_regions(image, count=None, pad=16, k=5.0):
+    """Returns (y0, x0, y1, x1) boxes around the bright sample regions
+
+    Sample spots are found as runs of columns whose mean stands out
+    from the background (the median column) by more than k times the
+    median absolute deviation, then each is bounded vertically the
+    same way within its columns. Only the count brightest regions are
+    kept when more are found. Boxes are grown by pad pixels on every
+    side and clipped to the image; they may overlap.
+    """
+    height, width = image.shape
+
+    def bright(profile):
+        median = np.median(profile)
+        spread = np.median(np.abs(profile - median))
+        return profile > median + k*max(spread, 1.0)
+
+    starts, stops = _runs(bright(image.mean(axis=0, dtype=np.float32)))
+    if count is not None and len(starts) > count:
+        columns = np.concatenate(([0], np.cumsum(image.sum(axis=0, dtype=np.float64))))
+        sums = columns[stops] - columns[starts]
+        keep = np.sort(np.argsort(sums)[::-1][:count])
+        starts, stops = starts[keep], stops[keep]
+    boxes = []
+    for x0, x1 in zip(starts, stops):
+        rows = bright(image[:, x0:x1].mean(axis=1, dtype=np.float32))
+        ys = np.flatnonzero(rows)
+        y0, y1 = (ys[0], ys[-1] + 1) if len(ys) else (0, height)
+        boxes.append((max(y0 - pad, 0), max(x0 - pad, 0),
+                      min(y1 + pad, height), min(x1 + pad, width)))
+    return np.array(boxes, np.int64).reshape(-1, 4)
+
+
+# measurements of one sample spot, as returned by measure_samples
+SAMPLE_RESULT = np.dtype([
+    ('integrated', '<f8'),      # spot sum above background
+    ('mean', '<f8'),            # mean spot level
+    ('background', '<f8'),      # mean level around the spot
+    ('snr', '<f8'),             # (mean - background) / background noise
+])
+
+
+@functools.lru_cache(maxsize=32)
+def sample_labels(shape, width, pitch=None, offset=None, center=None,
+                  radius=0.3, ring=1.5):
+    """Returns (top, labels, counts) of the sample regions of a frame
+
+    The samples are spots pitch pixels apart along the row at height
+    center, the first at column offset; by default they are centered
+    in width equal cells across the frame. A spot is the disc of radius
+    times pitch around its center and its background the pixels of its
+    square cell at least ring spot radii out. labels flattens the band
+    of frame rows starting at top that holds the cells, with sample i
+    labelled i in its spot, width + i in its background and 2*width
+    elsewhere; counts holds the number of pixels of each label.
+
+    The result depends only on the arguments, so it is cached and
+    shared: the arrays are read-only.
+    """
+    height, columns = shape
+    if pitch is None:
+        pitch = columns / width
+    if offset is None:
+        offset = (pitch - 1) / 2
+    if center is None:
+        center = (height - 1) / 2
+    half = pitch / 2
+    top = max(int(np.ceil(center - half)), 0)
+    bottom = min(int(np.floor(center + half)) + 1, height)
+    y = np.arange(top, bottom)[:, None]
+    x = np.arange(columns)[None, :]
+    sample = np.rint((x - offset) / pitch).astype(np.intp)
+    dx = x - (offset + sample*pitch)
+    inside = (sample >= 0) & (sample < width) & (np.abs(dx) <= half)
+    distance = np.hypot(y - center, dx)
+    labels = np.full(distance.shape, 2*width, np.intp)
+    spot = inside & (distance <= radius*pitch)
+    back = inside & (distance >= ring*radius*pitch)
+    labels[spot] = np.broadcast_to(sample, labels.shape)[spot]
+    labels[back] = width + np.broadcast_to(sample, labels.shape)[back]
+    labels = labels.ravel()
+    counts = np.bincount(labels, minlength=2*width + 1)
+    labels.flags.writeable = False
+    counts.flags.writeable = False
+    return top, labels, counts
+
+
+def measure_samples(image, width, pitch=None, offset=None, center=None,
+                    radius=0.3, ring=1.5):
+    """Returns a SAMPLE_RESULT for each of the width samples in a row image
+
+    The samples are laid out as in sample_labels. Every statistic comes
+    from two bincounts over the frame rows holding the samples, one of
+    the pixel values and one of their squares, so the cost does not
+    depend on the number of samples.
+    """
+    top, labels, counts = sample_labels(image.shape, width, pitch, offset,
+                                        center, radius, ring)
+    band = image[top:top + labels.size // image.shape[1]].ravel()
+    n = 2*width + 1
+    sums = np.bincount(labels, band, n)
+    squares = np.bincount(labels, np.square(band, dtype=np.float64), n)
+    count = np.maximum(counts, 1)
+    spots, backs = slice(0, width), slice(width, 2*width)
+
+    result = np.zeros(width, SAMPLE_RESULT)
+    result['mean'] = sums[spots] / count[spots]
+    result['background'] = sums[backs] / count[backs]
+    result['integrated'] = sums[spots] - result['background']*counts[spots]
+    noise = np.sqrt(np.maximum(squares[backs]/count[backs] - result['background']**2, 0))
+    result['snr'] = (result['mean'] - result['background']) / np.maximum(noise, 1e-9)
+    return result
+
+
+class ScanAnalyzer(threading.Thread):
+    """ Measures the frames of a scan on a background thread as they arrive
+
+    The scan thread submits each frame as soon as it is captured and
+    this thread fills in that row of the results matrix, so the whole
+    result is ready one frame's analysis after the last row lands.
+    Frames from a pool must hold a reference for the analyzer, which
+    hands them to done once measured. Analysis is optional to a scan,
+    so a frame that fails to measure is reported and its row left NaN;
+    it never stops the scan.
+
+    Attributes:
+        measure: function called as measure(image, width)
+        done: function called with each image once it has been measured
+        results: (rows, width) SAMPLE_RESULT matrix, NaN where not measured
+        measured: whether each row has been measured
+        error: last exception raised while measuring, if any
+        failures: number of frames that failed to measure
+        latency: seconds from submit to measured of the last frame
+        max_latency: longest latency so far
+    """
+    def __init__(self, measure, rows, width, done=None, maxsize=8):
+        """Start the analyzer thread"""
+        super().__init__(daemon=True)
+        self.measure = measure
+        self.done = done
+        self.width = width
+        self.results = np.zeros((rows, width), SAMPLE_RESULT)
+        for name in SAMPLE_RESULT.names:
+            self.results[name] = np.nan
+        self.measured = np.zeros(rows, bool)
+        self.error = None
+        self.failures = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.queue = Queue(maxsize)
+        self.start()
+
+    def submit(self, image, row):
+        """Queue the frame of a row for measuring"""
+        self.queue.put((image, row, perf_counter()))
+
+    def run(self):
+        """Measure queued frames until close() is called"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            image, row, submitted = item
+            try:
+                self.results[row] = self.measure(image, self.width)
+                self.measured[row] = True
+                self.latency = perf_counter() - submitted
+                self.max_latency = max(self.max_latency, self.latency)
+            except Exception as e:
+                self.error = e
+                self.failures += 1
+                print("Analysis of row %d failed: %r" % (row+1, e))
+            finally:
+                if self.done is not None:
+                    self.done(image)
+
+    def close(self):
+        """Wait for queued frames to be measured, return the results"""
+        self.queue.put(None)
+        self.join()
+        return self.results
+
+
+def _centroids(profile, positions, half):
+    """Returns the centroid of profile within half pixels of each position
+
+    Also returns the total weight around each position; profile must
+    already have its background removed.
+    """
+    steps = np.arange(-half, half + 1)
+    index = np.clip(np.rint(positions).astype(np.intp)[:, None] + steps, 0, len(profile) - 1)
+    weight = np.maximum(profile[index], 0)
+    total = weight.sum(axis=1)
+    return (index*weight).sum(axis=1) / np.maximum(total, 1e-9), total
+
+
+def fit_grid(image, width):
+    """Fits a row of width evenly spaced spots, returns a SpotGrid or None
+
+    The frame is projected onto the row axis, the spot period is the
+    strongest frequency of the projection's FFT (refined between
+    bins, and taken down to a subharmonic when that is nearly as
+    strong), and the grid phase gives the offset. The width
+    consecutive grid positions with the most signal are taken as the
+    spots, and pitch and offset are fitted to the spot centroids by
+    least squares. None is returned when no periodic row stands out,
+    or for fewer than two spots, which have no pitch.
+    """
+    if width < 2:
+        return None
+    columns = image.shape[1]
+    profile = image.mean(axis=0, dtype=np.float64)
+    profile -= np.median(profile)
+    power = np.abs(np.fft.rfft(profile))
+    # width spots fit in the frame and are at least 4 pixels apart
+    low, high = max(width - 1, 1), min(columns // 4, len(power) - 2)
+    if low >= high:
+        return None
+    k = low + np.argmax(power[low:high])
+    # require 6 times the median power; noise alone rarely passes 4
+    if power[k] < 6*np.median(power[low:high]):
+        return None
+    for n in (3, 2):
+        if k % n == 0 and k // n >= low and power[k // n] >= 0.5*power[k]:
+            k //= n
+            break
+    # parabolic interpolation between bins
+    a, b, c = power[k-1], power[k], power[k+1]
+    k = k + 0.5*(a - c) / (a - 2*b + c) if a - 2*b + c else k
+    pitch = columns / k
+    phase = np.angle(np.dot(profile, np.exp(-2j*np.pi*np.arange(columns)/pitch)))
+    first = (-phase / (2*np.pi) * pitch) % pitch
+    grid = np.arange(first, columns, pitch)
+    if len(grid) < width:
+        return None
+    level = profile[np.clip(np.rint(grid).astype(np.intp), 0, columns - 1)]
+    sums = np.convolve(level, np.ones(width), 'valid')
+    start = np.argmax(sums)
+    positions = grid[start:start + width]
+    centers, weight = _centroids(profile, positions, max(int(pitch / 4), 1))
+    if not weight.any():
+        return None
+    n = np.arange(width)
+    pitch, offset = np.polyfit(n, centers, 1, w=np.sqrt(weight))
+    rows = image[:, max(int(offset), 0):int(offset + width*pitch) + 1].mean(axis=1, dtype=np.float64)
+    rows -= np.median(rows)
+    peak = np.argmax(rows)
+    center = _centroids(rows, np.array([peak]), max(int(pitch / 4), 1))[0][0]
+    grid = SpotGrid(width, pitch, offset, center)
+    grid.residual = grid.check(image)
+    return grid
+
+
+class SpotGrid():
+    """ A fitted row of evenly spaced sample spots
+
+    Attributes:
+        width: number of spots
+        pitch: pixels between spots
+        offset: column of the first spot
+        center: row the spots are on
+        residual: RMS pixels of the spot centroids off the grid when fitted
+    """
+    def __init__(self, width, pitch, offset, center):
+        self.width = width
+        self.pitch = pitch
+        self.offset = offset
+        self.center = center
+        self.residual = 0.0
+
+    def layout(self):
+        """Returns the grid as measure_samples layout arguments
+
+        Rounded to a tenth of a pixel, so slightly different fits share
+        one cached label map.
+        """
+        return dict(pitch=round(float(self.pitch), 1), offset=round(float(self.offset), 1),
+                    center=round(float(self.center), 1))
+
+    def check(self, image):
+        """Returns the RMS pixels of the spot centroids in image off the grid
+
+        Only the band of rows holding the spots is read.
+        """
+        half = self.pitch / 2
+        top = max(int(self.center - half), 0)
+        band = image[top:int(self.center + half) + 1].mean(axis=0, dtype=np.float64)
+        band -= np.median(band)
+        positions = self.offset + self.pitch*np.arange(self.width)
+        centers, weight = _centroids(band, positions, max(int(self.pitch / 4), 1))
+        if not weight.any():
+            return np.inf
+        return float(np.sqrt(np.mean((centers - positions)**2)))
+
+
+class GridTracker():
+    """ Keeps a spot grid fit and reuses it while it still fits
+
+    Every frame is checked against the cached grid, which only reads
+    the spot band; the grid is refitted when the frame shape or sample
+    count changes or the spots drift off it by more than tolerance
+    pixels RMS beyond the residual of the fit. Safe to share between
+    threads.
+
+    Attributes:
+        grid: the current SpotGrid, or None
+        tolerance: pixels RMS of drift allowed before refitting
+        fits: number of fits made
+    """
+    def __init__(self, tolerance=1.0):
+        self.grid = None
+        self.tolerance = tolerance
+        self.fits = 0
+        self._shape = None
+        self._lock = threading.Lock()
+
+    def layout(self, image, width):
+        """Returns measure_samples layout arguments for a row image
+
+        An empty dict, the default layout, is returned if no grid can
+        be fitted.
+        """
+        with self._lock:
+            grid = self.grid
+            if (grid is None or grid.width != width or self._shape != image.shape
+                    or grid.check(image) > grid.residual + self.tolerance):
+                grid = fit_grid(image, width)
+                self.fits += 1
+                self.grid, self._shape = grid, image.shape
+            return grid.layout() if grid is not None else {}
+
+
+@functools.lru_cache(maxsize=1)
+def _tracker():
+    """Returns the GridTracker of this worker process"""
+    return GridTracker()
+
+
+# per-sample results of a batch, one record per sample of every frame
+BATCH_RESULT = np.dtype([
+    ('frame_id', '<i8'),        # the frame in the ScanCatalog
+    ('scan_id', '<i8'),
+    ('row', '<i4'),
+    ('sample', '<i4'),
+] + SAMPLE_RESULT.descr)
+
+
+@functools.lru_cache(maxsize=4)
+def _open(storage, path):
+    """Returns the stack or container at path, kept open per process"""
+    if storage == 'stack':
+        return ScanStack(path)
+    return ScanContainer(path)
+
+
+def _load(storage, path, frame):
+    """Returns a frame, mapped or decoded from disk in this process"""
+    if storage in ('tiff', 'fly'):
+        return imread(path)
+    if storage == 'stack':
+        return _open(storage, path).frames[frame]
+    return _open(storage, path).read(frame)
+
+
+def result_table(scan_id, frame_ids, rows, results):
+    """Returns a BATCH_RESULT table of (frames, width) sample results"""
+    results = np.asarray(results)
+    table = np.zeros(results.shape, BATCH_RESULT)
+    table['frame_id'] = np.reshape(frame_ids, (-1, 1))
+    table['scan_id'] = scan_id
+    table['row'] = np.reshape(rows, (-1, 1))
+    table['sample'] = np.arange(results.shape[1])
+    for name in SAMPLE_RESULT.names:
+        table[name] = results[name]
+    return table.ravel()
+
+
+def _measure_frames(tasks, layout):
+    """Worker: measures a batch of frames, returns their BATCH_RESULTs
+
+    The spot grid is fitted when layout is None.
+    """
+    tables = []
+    for frame_id, scan_id, row, storage, path, frame, width in tasks:
+        image = _load(storage, path, frame)
+        if layout is None:
+            result = measure_samples(image, width, **_tracker().layout(image, width))
+        else:
+            result = measure_samples(image, width, **layout)
+        tables.append(result_table(scan_id, [frame_id], [row], result[None]))
+    return np.concatenate(tables) if tables else np.zeros(0, BATCH_RESULT)
+
+
+def analyze_scans(catalog, scan_ids, workers=None, batch=16, grid=True, **layout):
+    """Measures every frame of the given scans in a pool of processes
+
+    Returns one BATCH_RESULT table of all their samples, which is also
+    added to the catalog. Only file names and frame indices are sent to
+    the workers: each maps or decodes its frames from disk itself, so
+    no pixel data is pickled. Frames go out in batches of batch frames
+    of the same file, so a worker reuses the stack or container it
+    opened and its cached sample labels. With grid set, each worker
+    finds the spots with a GridTracker; otherwise layout is passed on
+    to measure_samples.
+    """
+    tasks = []
+    for scan_id in scan_ids:
+        scan = catalog.scan(scan_id)
+        for f in catalog.frames(scan_id):
+            frame = f['frame'] if f['frame'] is not None else f['row']
+            tasks.append((f['frame_id'], scan_id, f['row'], scan['storage'],
+                          f['path'], frame, scan['width']))
+    tasks.sort(key=lambda task: (task[4], task[5]))
+    batches = [tasks[i:i+batch] for i in range(0, len(tasks), batch)]
+    with ProcessPoolExecutor(workers) as pool:
+        layouts = [None if grid else layout]*len(batches)
+        tables = list(pool.map(_measure_frames, batches, layouts))
+    table = np.concatenate(tables) if tables else np.zeros(0, BATCH_RESULT)
+    catalog.add_results(table)
+    return table
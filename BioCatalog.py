@@ -0,0 +1,184 @@
+"""SQLite catalog of biosensor scans"""
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,      -- seconds since the epoch
+    finished REAL,
+    sample_id TEXT,
+    width INTEGER,
+    rows INTEGER,
+    spacing REAL,               -- micrometers
+    start REAL,                 -- micrometers
+    storage TEXT,
+    directory TEXT
+);
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    scan_id INTEGER NOT NULL REFERENCES scans(id),
+    row INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    frame INTEGER,              -- index in a stack or container
+    position REAL,              -- micrometers
+    captured REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    frame_id INTEGER NOT NULL REFERENCES frames(id),
+    sample INTEGER NOT NULL,
+    integrated REAL,
+    mean REAL,
+    background REAL,
+    snr REAL,
+    PRIMARY KEY (frame_id, sample)
+);
+CREATE INDEX IF NOT EXISTS scans_started ON scans(started);
+CREATE INDEX IF NOT EXISTS scans_sample ON scans(sample_id, started);
+CREATE INDEX IF NOT EXISTS frames_scan ON frames(scan_id, row);
+CREATE INDEX IF NOT EXISTS frames_position ON frames(position);
+"""
+
+
+def _seconds(when):
+    """Returns a datetime or epoch seconds as epoch seconds"""
+    if isinstance(when, datetime):
+        return when.timestamp()
+    return when
+
+
+class ScanCatalog():
+    """ Indexed record of every scan, the frames it saved and their results
+
+    Scans are added when they start and each frame as soon as it is
+    saved, so the catalog is current even for a scan that is running
+    or died. Frames are identified by their frame_id, and the sample
+    results of a frame are replaced when it is analyzed again. Rows
+    come back as sqlite3.Row objects, accessible by column name. The
+    connection can be shared by the scan and writer threads.
+
+    Attributes:
+        path: the database file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            # readers are not blocked while a scan writes
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+
+    def begin_scan(self, width, rows, spacing, start, directory,
+                   storage='tiff', sample_id=None):
+        """Adds a scan that is starting, returns its id"""
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO scans (started, sample_id, width, rows, spacing,"
+                " start, storage, directory) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), sample_id, width, rows, spacing, start,
+                 storage, directory))
+            return cursor.lastrowid
+
+    def finish_scan(self, scan_id):
+        """Records the time a scan finished"""
+        with self._lock, self._db:
+            self._db.execute("UPDATE scans SET finished = ? WHERE id = ?",
+                             (time.time(), scan_id))
+
+    def add_frame(self, scan_id, row, path, position, captured, frame=None):
+        """Adds a saved frame of a scan"""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO frames (scan_id, row, path, frame, position,"
+                " captured) VALUES (?, ?, ?, ?, ?, ?)",
+                (scan_id, row, path, frame, position, captured))
+
+    def add_results(self, table):
+        """Adds per-sample results, an array of BioAnalysis.BATCH_RESULT"""
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results (frame_id, sample, integrated,"
+                " mean, background, snr) VALUES (?, ?, ?, ?, ?, ?)",
+                zip(table['frame_id'].tolist(), table['sample'].tolist(),
+                    table['integrated'].tolist(), table['mean'].tolist(),
+                    table['background'].tolist(), table['snr'].tolist()))
+
+    def results(self, scan_id):
+        """Returns the sample results of a scan by row and sample"""
+        return self._query(
+            "SELECT frames.row, frames.captured, results.* FROM results"
+            " JOIN frames ON frames.id = results.frame_id"
+            " WHERE frames.scan_id = ? ORDER BY frames.captured, results.sample",
+            (scan_id,))
+
+    def scan(self, scan_id):
+        """Returns a scan by id, or None"""
+        rows = self._query("SELECT * FROM scans WHERE id = ?", (scan_id,))
+        return rows[0] if rows else None
+
+    def latest_scan(self):
+        """Returns the most recently started scan, or None"""
+        rows = self._query("SELECT * FROM scans ORDER BY started DESC LIMIT 1")
+        return rows[0] if rows else None
+
+    def resumable_scan(self):
+        """Returns the latest unfinished scan that kept a journal, or None
+
+        Fly scans are not journaled, so they cannot be resumed.
+        """
+        rows = self._query("SELECT * FROM scans WHERE finished IS NULL"
+                           " AND storage != 'fly' ORDER BY started DESC LIMIT 1")
+        return rows[0] if rows else None
+
+    def find_scans(self, since=None, until=None, sample_id=None):
+        """Returns the scans started in a time range and/or of a sample
+
+        since and until are datetimes or epoch seconds.
+        """
+        where, args = self._where(since, until, sample_id)
+        return self._query("SELECT * FROM scans%s ORDER BY started" % where, args)
+
+    def frames(self, scan_id):
+        """Returns the frames of a scan in row order, then by time"""
+        return self._query("SELECT id AS frame_id, * FROM frames"
+                           " WHERE scan_id = ? ORDER BY row, captured",
+                           (scan_id,))
+
+    def find_frames(self, position, tolerance=1.0, since=None, until=None,
+                    sample_id=None):
+        """Returns frames taken within tolerance um of a stage position
+
+        The scans searched can be narrowed like in find_scans.
+        """
+        where, args = self._where(since, until, sample_id)
+        where = where.replace(" WHERE ", " AND ")
+        return self._query(
+            "SELECT frames.id AS frame_id, frames.* FROM frames"
+            " JOIN scans ON scans.id = frames.scan_id"
+            " WHERE frames.position BETWEEN ? AND ?%s ORDER BY frames.captured" % where,
+            [position - tolerance, position + tolerance] + args)
+
+    def close(self):
+        """Closes the database"""
+        self._db.close()
+
+    def _where(self, since, until, sample_id):
+        clauses, args = [], []
+        if since is not None:
+            clauses.append("scans.started >= ?")
+            args.append(_seconds(since))
+        if until is not None:
+            clauses.append("scans.started < ?")
+            args.append(_seconds(until))
+        if sample_id is not None:
+            clauses.append("scans.sample_id = ?")
+            args.append(sample_id)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), args
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
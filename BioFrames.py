@@ -0,0 +1,206 @@
+"""Frame buffer management for the biosensor camera"""
+import ctypes
+import threading
+from time import perf_counter
+
+import numpy as np
+
+
+class FramePool():
+    """ Reusable frame buffers keyed by frame format
+
+    Frames are checked out, passed on to whoever needs them (writer,
+    analysis...) and returned once the last holder releases them, so a
+    long scan keeps reusing the same few buffers instead of allocating
+    a new array for every frame.
+
+    Attributes:
+        allocate: function returning a new buffer for a frame format
+        key: function returning a hashable key for a frame format
+        allocated: number of buffers allocated so far
+    """
+    def __init__(self, allocate, key):
+        self.allocate = allocate
+        self.key = key
+        self.allocated = 0
+        self._free = {}     # key: list of idle buffers
+        self._held = {}     # id(buffer): [key, reference count]
+        self._lock = threading.Lock()
+
+    def checkout(self, frameformat):
+        """Returns a buffer for the frame format with one reference"""
+        key = self.key(frameformat)
+        with self._lock:
+            free = self._free.get(key)
+            buf = free.pop() if free else None
+        if buf is None:
+            buf = self.allocate(frameformat)
+            with self._lock:
+                self.allocated += 1
+        with self._lock:
+            self._held[id(buf)] = [key, 1]
+        return buf
+
+    def retain(self, buf):
+        """Adds a reference to a checked out buffer"""
+        with self._lock:
+            self._held[id(buf)][1] += 1
+
+    def release(self, buf):
+        """Drops a reference, returning the buffer to the pool at zero"""
+        with self._lock:
+            held = self._held[id(buf)]
+            held[1] -= 1
+            if held[1] == 0:
+                del self._held[id(buf)]
+                self._free.setdefault(held[0], []).append(buf)
+
+    def in_use(self):
+        """Returns the number of buffers currently checked out"""
+        with self._lock:
+            return len(self._held)
+
+    def clear(self):
+        """Drops all idle buffers"""
+        with self._lock:
+            self._free.clear()
+
+
+class FrameRing():
+    """ Ring of preallocated frames with sequence numbers and timestamps
+
+    A single producer puts frames in turn into the ring; consumers copy
+    frames out by sequence number. A frame is overwritten n frames after
+    it was put, and a consumer asking for a frame that is already gone
+    (or being overwritten while it copies) is counted as an overrun.
+
+    Attributes:
+        frames: (n, height, width) array holding the last n frames
+        seqs: sequence number of the frame in each slot, -1 when empty
+        times: perf_counter time each slot was filled
+        count: number of frames completely put so far
+        overruns: number of frames consumers lost to overwriting
+        dropped: number of driver frames of the wrong size, not put
+    """
+    def __init__(self, n, shape, dtype):
+        self.frames = np.empty((n,) + tuple(shape), dtype)
+        self.seqs = np.full(n, -1, np.int64)
+        self.times = np.zeros(n)
+        self.count = 0
+        self.overruns = 0
+        self.dropped = 0
+        self._started = 0   # frames whose copy into the ring has begun
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        """Copies a frame into the next slot"""
+        i = self._begin()
+        np.copyto(self.frames[i], frame)
+        self._end(i)
+
+    def put_from(self, pointer, nbytes):
+        """Copies a frame from a driver buffer into the next slot
+
+        A buffer that is not exactly one frame is dropped, rather than
+        leaving part of the slot from an older frame.
+        """
+        slot = self.frames[self._started % len(self.frames)]
+        if nbytes != slot.nbytes:
+            self.dropped += 1
+            return
+        i = self._begin()
+        ctypes.memmove(slot.ctypes.data, pointer, nbytes)
+        self._end(i)
+
+    def _begin(self):
+        self._started += 1
+        return (self._started - 1) % len(self.frames)
+
+    def _end(self, i):
+        self.seqs[i] = self._started - 1
+        self.times[i] = perf_counter()
+        with self._cond:
+            self.count = self._started
+            self._cond.notify_all()
+
+    def wait(self, seq, timeout=None):
+        """Waits until frame seq has been put, returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.count > seq, timeout)
+
+    def get(self, seq, out=None):
+        """Returns (frame, time) for frame seq, or None if it was lost
+
+        The frame is copied into out, or into a new array.
+        """
+        i = seq % len(self.frames)
+        if seq >= self.count or not self._intact(seq):
+            if seq < self.count:
+                self.overruns += 1
+            return None
+        if out is None:
+            out = np.empty_like(self.frames[i])
+        np.copyto(out, self.frames[i])
+        t = self.times[i]
+        # the producer may have lapped us while copying
+        if not self._intact(seq):
+            self.overruns += 1
+            return None
+        return out, t
+
+    def latest(self, out=None):
+        """Returns (seq, frame, time) for the newest frame, or None"""
+        seq = self.count - 1
+        if seq < 0:
+            return None
+        result = self.get(seq, out)
+        if result is None:
+            return None
+        return (seq,) + result
+
+    def _intact(self, seq):
+        return self._started <= seq + len(self.frames)
+
+
+class StreamingCapture():
+    """ Streams video from the camera into a FrameRing
+
+    Used as a context manager: on entry a streaming callback is added
+    that copies every frame from the driver buffer into the ring, and
+    streaming is started; on exit both are undone. Frames arrive at the
+    full stream rate without any per-frame allocation.
+
+    Attributes:
+        camera: the camera object
+        nframes: number of frames in the ring
+        ring: the FrameRing, available once streaming has started
+    """
+    def __init__(self, camera, nframes=32):
+        self.camera = camera
+        self.nframes = nframes
+        self.ring = None
+        self._callbackid = None
+
+    def __enter__(self):
+        frame = self.camera.frame_buffer(self.camera.GetFormat()[0])
+        self.ring = FrameRing(self.nframes, frame.shape, frame.dtype)
+        self._callbackid = self.camera.AddStreamingCallback(self._on_frame)
+        try:
+            self.camera.StreamVideoControl('start_streaming')
+        except Exception:
+            self.camera.RemoveStreamingCallback(self._callbackid)
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.camera.StreamVideoControl('stop_streaming')
+        finally:
+            self.camera.RemoveStreamingCallback(self._callbackid)
+
+    def _on_frame(self, context, pdata, size):
+        """Driver callback, called on the driver thread for every frame"""
+        self.ring.put_from(pdata, size)
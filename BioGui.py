@@ -2,6 +2,15 @@
 from tkinter import filedialog
 from tkinter import *
 from PIL import ImageTk, Image
+import numpy as np
+
+# Scan storage choices and the take_scan storage for each
+STORAGE = {
+    "TIFF files": 'tiff',
+    "Stack file": 'stack',
+    "Container": 'container',
+    "Sample crops": 'roi',
+}
 
 class BioGui:
     """The main GUI for a biosensor.
@@ -53,6 +62,11 @@ class InputVariableWidget:
         width: number of samples in a row
         rows: number of rows of samples
         spacing: space between adjacent samples
+        pipelined: whether to save images in the background during scans
+        adaptive_settle: whether to wait for the image to settle after moves
+        storage: how scans are stored, one of STORAGE
+        sample_id: name of the sample scanned, recorded in the catalog
+        hdr: whether to capture raw 16 bit frames
     """
     def __init__(self, master):
 
@@ -64,11 +78,19 @@ class InputVariableWidget:
         self.width = IntVar()
         self.rows = IntVar()
         self.spacing = DoubleVar()
+        self.pipelined = BooleanVar()
+        self.adaptive_settle = BooleanVar()
+        self.storage = StringVar()
+        self.sample_id = StringVar()
+        self.hdr = BooleanVar()
 
         # Setting the initial values to what I expect them to be
         self.width.set(50)
         self.rows.set(40)
         self.spacing.set(400)
+        self.pipelined.set(True)
+        self.adaptive_settle.set(False)
+        self.storage.set("TIFF files")
 
         # Adding each component to the widget
         Label(self.frame, text="Input Variables:").grid(row=0,sticky=W,columnspan=3)
@@ -89,6 +111,17 @@ class InputVariableWidget:
         self.spacing_entry.grid(row=3,column=1)
         Label(self.frame, text="micrometers").grid(row=3,column=3)
 
+        Checkbutton(self.frame, text="Pipelined scan",
+            variable=self.pipelined).grid(row=4,columnspan=2,sticky=W)
+        Checkbutton(self.frame, text="Adaptive settle",
+            variable=self.adaptive_settle).grid(row=5,columnspan=2,sticky=W)
+        Label(self.frame, text="Storage:").grid(row=6,sticky=W)
+        OptionMenu(self.frame, self.storage, *STORAGE).grid(row=6,column=1,sticky=W)
+        Label(self.frame, text="Sample ID:").grid(row=7,sticky=W)
+        Entry(self.frame, textvariable=self.sample_id).grid(row=7,column=1)
+        Checkbutton(self.frame, text="16 bit (HDR)",
+            variable=self.hdr).grid(row=8,columnspan=2,sticky=W)
+
 
 class StepperControlWidget:
     """Contains manual controls for the stepper motor.
@@ -102,12 +135,14 @@ class StepperControlWidget:
         frame: the frame
         target: user input move destination
         pos_display: Label that display current position
+        motion: the move started here that is in progress, or None
     """
     def __init__(self, master, stepper, display):
 
         # save stepper and display object
         self.stepper = stepper
         self.display = display
+        self.motion = None
         # Create the whole frame to be added
         self.frame = Frame(master)
         self.frame.grid()
@@ -132,13 +167,31 @@ class StepperControlWidget:
         self.pos_display.grid(row=3,column=3,columnspan=2)
 
     def move(self, amount):
-        self.stepper.move(amount)
-        self.display.update_image()
-        self.update_pos_display()
-
+        # pos only updates when a move completes, so clicks during a
+        # move add up from its target
+        start = self.stepper.pos if self.motion is None else self.motion.pos
+        motion = self.stepper.start_move_to(start + amount)
+        if motion is None:
+            print("out of bounds")
+        self.follow(motion)
 
     def move_to(self, pos):
-        self.stepper.move_to(pos)
+        self.follow(self.stepper.start_move_to(pos))
+
+    def follow(self, motion):
+        """Update the display when a move finishes without blocking Tk"""
+        if motion is None:
+            return
+        if motion.cancelled():
+            if self.motion is motion:
+                self.motion = None
+            return
+        self.motion = motion
+        if not motion.done():
+            self.frame.after(20, self.follow, motion)
+            return
+        self.motion = None
+        self.stepper.wait_motion(motion)
         self.display.update_image()
         self.update_pos_display()
 
@@ -163,15 +216,22 @@ class PictureFrame:
         self.frame.grid()
 
         self.biosensor.image = self.biosensor.take_picture()
-        self.img = ImageTk.PhotoImage(Image.fromarray(self.biosensor.image, 'L'))
+        self.img = self.photo(self.biosensor.image)
         self.display = Label(self.frame, text="camera display", image = self.img)
         self.display.grid()
 
     def update_image(self):
         self.biosensor.image = self.biosensor.take_picture()
-        self.img = ImageTk.PhotoImage(Image.fromarray(self.biosensor.image, 'L'))
+        self.img = self.photo(self.biosensor.image)
         self.display.configure(image = self.img)
 
+    def photo(self, image):
+        """Returns a PhotoImage of a frame, scaled to 8 bits for display"""
+        if image.dtype.itemsize > 1:
+            shift = max(self.biosensor.depth - 8, 0)
+            image = np.minimum(image >> shift, 255).astype(np.uint8)
+        return ImageTk.PhotoImage(Image.fromarray(image, 'L'))
+
 
 class ScanControlWidget:
     """Contains master controls for the biosensor GUI.
@@ -195,13 +255,38 @@ class ScanControlWidget:
         b1 = Button(self.frame, text="Update Image", command=display.update_image, width=20)
         b2 = Button(self.frame, text="Save Image", command=self.save_image, width=20)
         b3 = Button(self.frame, text="Run Scan", command=self.run_scan, width=20)
+        b4 = Button(self.frame, text="Run Fly Scan", command=self.run_fly_scan, width=20)
+        b5 = Button(self.frame, text="Resume Scan", command=self.resume_scan, width=20)
 
         b1.grid(row=1,column=0,sticky=W)
         b2.grid(row=2,column=0,sticky=W)
         b3.grid(row=3,column=0,sticky=W)
+        b4.grid(row=4,column=0,sticky=W)
+        b5.grid(row=5,column=0,sticky=W)
+
+    def apply_settings(self):
+        self.biosensor.adaptive_settle = self.input.adaptive_settle.get()
+        if self.input.hdr.get() != self.biosensor.hdr:
+            self.biosensor.set_hdr(self.input.hdr.get())
 
     def run_scan(self):
-        self.biosensor.take_scan(self.input.width.get(), self.input.rows.get(), self.input.spacing.get())
+        self.apply_settings()
+        self.biosensor.take_scan(self.input.width.get(), self.input.rows.get(), self.input.spacing.get(),
+            pipelined=self.input.pipelined.get(), storage=STORAGE[self.input.storage.get()],
+            sample_id=self.input.sample_id.get() or None)
+
+    def resume_scan(self):
+        self.biosensor.adaptive_settle = self.input.adaptive_settle.get()
+        try:
+            self.biosensor.resume_scan(pipelined=self.input.pipelined.get())
+        finally:
+            # the scan's bit depth was restored
+            self.input.hdr.set(self.biosensor.hdr)
+
+    def run_fly_scan(self):
+        self.apply_settings()
+        self.biosensor.fly_scan(self.input.width.get(), self.input.rows.get(), self.input.spacing.get(),
+            sample_id=self.input.sample_id.get() or None)
 
     def save_image(self):
         image = self.biosensor.take_picture()
@@ -0,0 +1,210 @@
+"""Scan bookkeeping for the biosensor"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from BioStorage import ScanStack, ScanContainer
+
+
+def file_checksum(path):
+    """Returns the SHA-1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def data_checksum(data):
+    """Returns the SHA-1 hex digest of an array's data"""
+    return hashlib.sha1(np.ascontiguousarray(data)).hexdigest()
+
+
+class ScanPlan():
+    """ Absolute stage targets for the rows of a scan
+
+    Every row target is computed in steps straight from the start
+    position, so rounding does not build up from row to row the way it
+    does with repeated relative moves. Rows are visited first to last,
+    or last to first in a reversed plan.
+
+    Attributes:
+        start: stage position of the first row in micrometers
+        spacing: space between rows in micrometers
+        rows: number of rows
+        scale: stepper steps per micrometer
+        reverse: whether the rows are visited last to first
+        targets: stage target of each row in steps
+    """
+    def __init__(self, start, spacing, rows, scale, reverse=False):
+        self.start = start
+        self.spacing = spacing
+        self.rows = rows
+        self.scale = scale
+        self.reverse = reverse
+        self.targets = [int(round((start + i*spacing)*scale)) for i in range(rows)]
+
+    def position(self, row):
+        """Returns the stage position of a row in micrometers"""
+        return self.targets[row] / self.scale
+
+    def order(self):
+        """Returns the rows in the order they are visited"""
+        order = list(range(self.rows))
+        return order[::-1] if self.reverse else order
+
+    def end(self):
+        """Returns the stage position the scan finishes at
+
+        A plan without rows finishes where it starts.
+        """
+        if not self.rows:
+            return self.start
+        return self.position(self.order()[-1])
+
+    def reversed(self):
+        """Returns the plan visiting the same rows the other way round"""
+        return ScanPlan(self.start, self.spacing, self.rows, self.scale,
+                        not self.reverse)
+
+    def params(self):
+        """Returns the plan parameters as a dict"""
+        return dict(start=self.start, spacing=self.spacing, rows=self.rows,
+                    scale=self.scale, reverse=self.reverse)
+
+
+class ScanJournal():
+    """ On-disk record of the rows a scan has completed
+
+    The journal is a text file with one JSON record per line: a header
+    with the scan parameters, then one record per saved row with its
+    stage position, file path and checksum. Every line is flushed to
+    disk as it is written, so the journal survives a crash mid-scan
+    and the scan can be resumed from it.
+
+    Attributes:
+        path: the journal file
+        width: number of samples in a row
+        plan: the ScanPlan of the scan
+        stack: the ScanStack file holding the frames, or None
+        container: the ScanContainer holding the frames, or None
+        directory: the directory the scan saves to
+        scan_id: the scan's id in the ScanCatalog, or None
+        hdr: whether the scan captures raw 16 bit frames
+        passes: number of passes of a time-lapse, or None for a scan
+        period: seconds between the passes of a time-lapse
+        pass_index: the time-lapse pass this journal is for, from 0
+        done: record of each completed row, by row index
+    """
+    def __init__(self, path, width, plan, stack=None, container=None, done=None,
+                 directory='pics', scan_id=None, hdr=False, passes=None,
+                 period=None, pass_index=0):
+        self.path = path
+        self.width = width
+        self.plan = plan
+        self.stack = stack
+        self.container = container
+        self.directory = directory
+        self.scan_id = scan_id
+        self.hdr = hdr
+        self.passes = passes
+        self.period = period
+        self.pass_index = pass_index
+        self.done = done if done is not None else {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, width, plan, stack=None, container=None,
+               directory='pics', scan_id=None, hdr=False, passes=None,
+               period=None, pass_index=0):
+        """Starts a new journal, replacing any old one at path"""
+        journal = cls(path, width, plan, stack, container,
+                      directory=directory, scan_id=scan_id, hdr=hdr,
+                      passes=passes, period=period, pass_index=pass_index)
+        journal._file = open(path, 'w')
+        journal._write(dict(width=width, plan=plan.params(), stack=stack,
+                            container=container, directory=directory,
+                            scan_id=scan_id, hdr=hdr, passes=passes,
+                            period=period, pass_index=pass_index))
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        """Opens an existing journal to continue it
+
+        Rows whose file is missing or no longer matches its checksum are
+        not counted as done. A line cut short by a crash is ignored.
+        """
+        with open(path) as f:
+            text = f.read()
+        lines = text.splitlines()
+        header = json.loads(lines[0])
+        stack = header.get('stack')
+        frames = ScanStack(stack).frames if stack and os.path.exists(stack) else None
+        container = header.get('container')
+        if container and os.path.exists(container):
+            chunks = ScanContainer(container)
+            count = len(chunks)
+        done = {}
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if stack:
+                ok = frames is not None and data_checksum(frames[record['row']]) == record['sha1']
+            elif container:
+                index = record['index']
+                ok = (os.path.exists(container) and index < count
+                      and data_checksum(chunks.read(index)) == record['sha1'])
+            else:
+                saved = record['path']
+                ok = os.path.exists(saved) and file_checksum(saved) == record['sha1']
+            if ok:
+                done[record['row']] = record
+        if container and os.path.exists(container):
+            chunks.close()
+        journal = cls(path, header['width'], ScanPlan(**header['plan']),
+                      stack, container, done, header.get('directory', 'pics'),
+                      header.get('scan_id'), header.get('hdr', False),
+                      header.get('passes'), header.get('period'),
+                      header.get('pass_index', 0))
+        journal._file = open(path, 'a')
+        if not text.endswith('\n'):
+            # finish the line cut short so new records start on their own
+            journal._file.write('\n')
+        return journal
+
+    def remaining(self):
+        """Returns the rows that still have to be taken, in plan order"""
+        return [i for i in self.plan.order() if i not in self.done]
+
+    def record(self, row, pos, filename, data=None, index=None):
+        """Records a row as done once it has been saved
+
+        The checksum is taken over the saved file, or over data, the
+        row's frame, when given (for rows kept in a stack or container).
+        index is the frame's index in a container.
+        """
+        sha1 = file_checksum(filename) if data is None else data_checksum(data)
+        record = dict(row=row, pos=pos, path=filename, sha1=sha1)
+        if index is not None:
+            record['index'] = index
+        with self._lock:
+            self._write(record)
+            self.done[row] = record
+
+    def close(self):
+        """Closes the journal file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
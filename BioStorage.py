@@ -0,0 +1,682 @@
+"""Storage helpers for the biosensor scans"""
+import json
+import lzma
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from queue import Queue
+from time import perf_counter
+
+import numpy as np
+
+from BioTiff import TiffWriter, imread, pack12, unpack12
+
+# binning factors of the pyramid levels and the largest thumbnail side
+PYRAMID_LEVELS = (2, 4, 8)
+THUMBNAIL_SIZE = 256
+
+
+class FrameWriter(threading.Thread):
+    """ Saves images on a background thread
+
+    The scan thread submits images and moves on; this thread writes them
+    out, so a disk write overlaps the next stage move and exposure. The
+    queue is bounded so a slow disk stalls the scan instead of piling up
+    frames in memory. Images that queued up while a write was running
+    are written together as one batch.
+
+    save may return what it wrote, a path or an object with a sync()
+    method, for the fsync policy: 'never' leaves flushing to the OS,
+    'batch' syncs everything written once per batch and 'always' syncs
+    after every image.
+
+    Attributes:
+        save: function called as save(image, filename, ...)
+        done: function called with each image once it has been handled
+        queue: bounded queue of save arguments
+        fsync: the fsync policy
+        batch: most images written per batch
+        error: first exception raised while saving, if any
+        written: number of images saved
+        latency: seconds from submit to saved of the last image
+        max_latency: longest latency so far
+        blocked: total seconds producers waited on a full queue
+    """
+    def __init__(self, save, maxsize=4, done=None, fsync='never', batch=8):
+        """Start the writer thread"""
+        super().__init__(daemon=True)
+        if fsync not in ('never', 'batch', 'always'):
+            raise ValueError("fsync must be 'never', 'batch' or 'always'")
+        self.save = save
+        self.done = done
+        self.queue = Queue(maxsize)
+        self.fsync = fsync
+        self.batch = batch
+        self.error = None
+        self.written = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.blocked = 0.0
+        self._latency_total = 0.0
+        self.start()
+
+    def submit(self, image, filename, *args):
+        """Queue an image for saving, blocking while the queue is full
+
+        Any extra arguments are passed on to save. Returns a Future of
+        what save returns.
+        """
+        if self.error is not None:
+            raise self.error
+        future = Future()
+        start = perf_counter()
+        self.queue.put((future, start, (image, filename) + args))
+        self.blocked += perf_counter() - start
+        return future
+
+    def depth(self):
+        """Returns the number of images waiting to be written"""
+        return self.queue.qsize()
+
+    def mean_latency(self):
+        """Returns the mean seconds from submit to saved"""
+        return self._latency_total / self.written if self.written else 0.0
+
+    def run(self):
+        """Save queued images until close() is called"""
+        stop = False
+        while not stop:
+            items = [self.queue.get()]
+            while len(items) < self.batch and not self.queue.empty():
+                items.append(self.queue.get())
+            if items[-1] is None:
+                items.pop()
+                stop = True
+            written = []
+            for future, submitted, args in items:
+                try:
+                    # Once a write fails, drain the queue without writing
+                    if self.error is not None:
+                        raise self.error
+                    result = self.save(*args)
+                    if self.fsync == 'always':
+                        sync(result)
+                    elif self.fsync == 'batch' and result not in written:
+                        written.append(result)
+                except Exception as e:
+                    if self.error is None:
+                        self.error = e
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                    self._saved(perf_counter() - submitted)
+                if self.done is not None:
+                    self.done(args[0])
+            for result in written:
+                sync(result)
+
+    def _saved(self, latency):
+        self.written += 1
+        self.latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self._latency_total += latency
+
+    def close(self):
+        """Wait for queued images to be written and stop the thread"""
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def sync(saved):
+    """Forces a saved file, given by path or sync() object, to disk"""
+    if saved is None:
+        return
+    if hasattr(saved, 'sync'):
+        saved.sync()
+    else:
+        with open(saved, 'rb+') as f:
+            os.fsync(f.fileno())
+
+
+def bin_image(image, factor):
+    """Returns the means of factor x factor blocks of an image as float32
+
+    Rows and columns that do not fill a whole block are dropped.
+    """
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:height*factor, :width*factor].reshape(height, factor, width, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def pyramid(image, levels=PYRAMID_LEVELS, thumbnail=THUMBNAIL_SIZE):
+    """Returns the binned levels of an image and a thumbnail
+
+    Each level is binned from the previous one, so the whole pyramid
+    costs little more than the first level. The thumbnail is binned by
+    powers of two until it fits in thumbnail pixels. All are returned
+    in the image's dtype.
+    """
+    images = []
+    current, binned = image, 1
+    for factor in levels:
+        current = bin_image(current, factor // binned)
+        binned = factor
+        images.append(current)
+    while max(current.shape) > thumbnail:
+        current = bin_image(current, 2)
+    images.append(current)
+    return [np.rint(level).astype(image.dtype) for level in images]
+
+
+def pyramid_path(directory, row):
+    """Returns the pyramid file of a scan row"""
+    return os.path.join(directory, 'test%d.pyramid.tif' % (row+1))
+
+
+def write_pyramid(path, image, bits=None):
+    """Writes the pyramid of an image to a TIFF, one page per level
+
+    The pages are the PYRAMID_LEVELS in order, then the thumbnail; see
+    read_pyramid.
+    """
+    with TiffWriter(path, description='pyramid %s' % ' '.join(map(str, PYRAMID_LEVELS))) as tif:
+        for level in pyramid(image):
+            tif.write(level, bits)
+
+
+def read_pyramid(path, factor=None):
+    """Returns a level of a pyramid file by binning factor
+
+    The thumbnail is returned when factor is None.
+    """
+    page = len(PYRAMID_LEVELS) if factor is None else PYRAMID_LEVELS.index(factor)
+    return imread(path, page)
+
+
+class ScanStack():
+    """ A whole scan in one file-backed (rows, height, width) array
+
+    The file is a small header followed by the raw frames, so frames can
+    be captured straight into their slot and read back by slicing a
+    memmap, without decoding anything. The header holds a done flag per
+    row, set once the row's frame is complete, so analysis can open the
+    stack while the scan is still filling it.
+
+    Attributes:
+        path: the stack file
+        frames: memmap of all frames, shape (rows, height, width)
+        done: memmap of the per-row done flags
+    """
+    MAGIC = b'BIOSTACK'
+    HEADER = struct.Struct('<8sIIII8s')  # magic, version, rows, height, width, dtype
+
+    def __init__(self, path, mode='r'):
+        """Opens an existing stack, read-only unless mode is 'r+'"""
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, rows, height, width, dtype = self.HEADER.unpack(
+                f.read(self.HEADER.size))
+        if magic != self.MAGIC or version != 1:
+            raise ValueError("%s is not a scan stack" % path)
+        dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        self.done = np.memmap(path, np.uint8, mode, self.HEADER.size, (rows,))
+        self.frames = np.memmap(path, dtype, mode, self._offset(rows),
+                                (rows, height, width))
+
+    @classmethod
+    def create(cls, path, rows, shape, dtype):
+        """Creates a stack of empty frames and opens it for writing"""
+        dtype = np.dtype(dtype)
+        height, width = shape
+        with open(path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, 1, rows, height, width,
+                                    dtype.str.encode('ascii')))
+            f.truncate(cls._offset(rows) + rows*height*width*dtype.itemsize)
+        return cls(path, 'r+')
+
+    @classmethod
+    def _offset(cls, rows):
+        """Returns the file offset of the frames, 64 byte aligned"""
+        return -(-(cls.HEADER.size + rows) // 64) * 64
+
+    def mark_done(self, row):
+        """Flushes the frames to disk and marks a row as complete"""
+        self.frames.flush()
+        self.done[row] = 1
+        self.done.flush()
+
+    def rows_done(self):
+        """Returns the indices of the complete rows"""
+        return np.flatnonzero(self.done)
+
+
+def _encode_none(frame, level):
+    return frame.tobytes()
+
+
+def _decode_none(data, shape, dtype):
+    return np.frombuffer(data, dtype).reshape(shape).copy()
+
+
+def _encode_zlib(frame, level):
+    return zlib.compress(np.ascontiguousarray(frame), level)
+
+
+def _decode_zlib(data, shape, dtype):
+    return np.frombuffer(zlib.decompress(data), dtype).reshape(shape)
+
+
+def _encode_lzma(frame, level):
+    return lzma.compress(np.ascontiguousarray(frame), preset=level)
+
+
+def _decode_lzma(data, shape, dtype):
+    return np.frombuffer(lzma.decompress(data), dtype).reshape(shape)
+
+
+def _encode_delta_zlib(frame, level):
+    # neighbouring pixels are similar, so their differences compress
+    # better; unsigned wrap-around keeps the delta lossless
+    delta = np.array(frame)
+    np.subtract(frame[..., 1:], frame[..., :-1], out=delta[..., 1:])
+    return zlib.compress(delta, level)
+
+
+def _decode_delta_zlib(data, shape, dtype):
+    delta = np.frombuffer(zlib.decompress(data), dtype).reshape(shape)
+    return np.cumsum(delta, axis=-1, dtype=dtype)
+
+
+def _encode_packed12(frame, level):
+    # 12 bit samples in 16 bit frames, two samples to three bytes
+    return pack12(frame).tobytes()
+
+
+def _decode_packed12(data, shape, dtype):
+    packed = np.frombuffer(data, np.uint8).reshape(shape[0], -1)
+    return unpack12(packed, shape[1]).astype(dtype, copy=False)
+
+
+def _encode_packed12_zlib(frame, level):
+    return zlib.compress(pack12(frame), level)
+
+
+def _decode_packed12_zlib(data, shape, dtype):
+    return _decode_packed12(zlib.decompress(data), shape, dtype)
+
+
+# codec name: (encode(frame, level), decode(data, shape, dtype))
+CODECS = {
+    'none': (_encode_none, _decode_none),
+    'zlib': (_encode_zlib, _decode_zlib),
+    'lzma': (_encode_lzma, _decode_lzma),
+    'delta-zlib': (_encode_delta_zlib, _decode_delta_zlib),
+    'packed12': (_encode_packed12, _decode_packed12),
+    'packed12-zlib': (_encode_packed12_zlib, _decode_packed12_zlib),
+}
+
+
+def _encode_timed(codec, frame, level):
+    """Encodes a frame, returns the chunk and the seconds it took"""
+    start = perf_counter()
+    chunk = CODECS[codec][0](frame, level)
+    return chunk, perf_counter() - start
+
+
+def benchmark_codecs(frame, level=6, codecs=None):
+    """Returns the compression ratio and MB/s of each codec on a frame
+
+    Timings are for one core; multiply by the workers of a Compressor
+    for its total rate.
+    """
+    results = {}
+    for codec in codecs or CODECS:
+        chunk, seconds = _encode_timed(codec, frame, level)
+        results[codec] = dict(ratio=frame.nbytes / len(chunk),
+                              mbps=frame.nbytes / 1e6 / max(seconds, 1e-9))
+    return results
+
+
+class Compressor():
+    """ Compresses frames in a pool of worker processes
+
+    Frames are submitted as they are captured and encoded in parallel,
+    so a slow codec does not hold up the scan. The size and time of
+    every encoded frame is tallied per codec.
+
+    Attributes:
+        codec: default codec name in CODECS
+        level: compression level
+        pool: the ProcessPoolExecutor
+        totals: [raw bytes, compressed bytes, seconds] per codec
+    """
+    def __init__(self, codec='zlib', level=6, workers=None):
+        self.codec = codec
+        self.level = level
+        self.pool = ProcessPoolExecutor(workers)
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def submit(self, frame, codec=None):
+        """Starts encoding a frame, returns a Future of (chunk, seconds)
+
+        The frame must not be changed until the Future is done.
+        """
+        codec = codec or self.codec
+        future = self.pool.submit(_encode_timed, codec, frame, self.level)
+        future.add_done_callback(lambda f: self._tally(codec, frame.nbytes, f))
+        return future
+
+    def _tally(self, codec, nbytes, future):
+        if future.exception() is not None:
+            return
+        chunk, seconds = future.result()
+        with self._lock:
+            total = self.totals.setdefault(codec, [0, 0, 0.0])
+            total[0] += nbytes
+            total[1] += len(chunk)
+            total[2] += seconds
+
+    def report(self):
+        """Returns the compression ratio and per-core MB/s of each codec"""
+        with self._lock:
+            return {codec: dict(ratio=raw / max(packed, 1),
+                                mbps=raw / 1e6 / max(seconds, 1e-9))
+                    for codec, (raw, packed, seconds) in self.totals.items()}
+
+    def close(self):
+        """Waits for pending frames and stops the workers"""
+        self.pool.shutdown()
+
+# one metadata record per frame in a ScanContainer
+FRAME_RECORD = np.dtype([
+    ('row', '<i4'),
+    ('position', '<f8'),        # micrometers
+    ('steps', '<i8'),
+    ('exposure', '<f4'),        # ms
+    ('gain', '<f4'),
+    ('capture_time', '<f8'),    # seconds since the epoch
+    ('write_time', '<f8'),
+    ('offset', '<u8'),          # of the compressed chunk in frames.bin
+    ('nbytes', '<u8'),
+])
+
+
+# one record per stored crop in a region container
+CROP_RECORD = np.dtype([
+    ('frame', '<u4'),           # index of the frame the crop belongs to
+    ('y', '<u4'),
+    ('x', '<u4'),
+    ('height', '<u4'),
+    ('width', '<u4'),
+    ('offset', '<u8'),
+    ('nbytes', '<u8'),
+])
+
+
+# keyframe index of a frame in a time-lapse container, -1 for a keyframe
+REF = np.dtype('<i8')
+
+
+def split_regions(frame, boxes, factor):
+    """Returns the context and crops to store for a frame
+
+    The context is the frame binned by factor; the crops are
+    ((y, x), array) for each (y0, x0, y1, x1) box.
+    """
+    context = np.rint(bin_image(frame, factor)).astype(frame.dtype)
+    crops = [((y0, x0), frame[y0:y1, x0:x1]) for y0, x0, y1, x1 in boxes]
+    return context, crops
+
+
+def reconstruct(context, crops, shape, factor):
+    """Returns a full frame from its context and crops
+
+    The context is blown back up to full size, with edge pixels that
+    the binning dropped repeated, and the crops are pasted over it.
+    """
+    full = np.repeat(np.repeat(context, factor, axis=0), factor, axis=1)
+    full = np.pad(full, [(0, n - m) for n, m in zip(shape, full.shape)], 'edge')
+    for (y, x), crop in crops:
+        full[y:y+crop.shape[0], x:x+crop.shape[1]] = crop
+    return full
+
+
+class ScanContainer():
+    """ A directory holding compressed frames and their metadata
+
+    Every frame is compressed into its own chunk and appended to
+    frames.bin; its metadata record (row, stage position, exposure,
+    gain, capture and write time, chunk location) is appended to the
+    fixed-size record table index.bin. Frames can be appended while the
+    scan runs and any frame is read back with one seek.
+
+    A region container (context set) keeps only crops of the sample
+    regions at full resolution, plus the whole frame binned by context.
+    The frame record points at the binned frame and the crops are
+    listed in crops.bin, so read() can put the full frame back together.
+
+    A time-lapse container (keyframes set) is for the same rows scanned
+    over and over. The first frame of each row is stored whole as its
+    keyframe and later ones as their difference from it, which is
+    mostly zeros and compresses far better; every keyframes frames of a
+    row a new keyframe is stored. refs.bin holds the keyframe index of
+    every frame, -1 for keyframes, and a frame is decoded with one add.
+
+    Attributes:
+        path: the container directory
+        shape: shape of every frame
+        dtype: dtype of every frame
+        codec: name of the codec in CODECS
+        level: compression level
+        context: binning of the context frame in a region container, or None
+        keyframes: frames per keyframe of a row in a time-lapse container, or None
+    """
+    def __init__(self, path, mode='r'):
+        """Opens an existing container, for appending if mode is 'a'"""
+        self.path = path
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.codec = header['codec']
+        self.level = header['level']
+        self.context = header.get('context')
+        self.keyframes = header.get('keyframes')
+        self._encode, self._decode = CODECS[self.codec]
+        self._lock = threading.RLock()
+        self._data = open(os.path.join(path, 'frames.bin'), 'a+b' if mode == 'a' else 'rb')
+        self._index = open(os.path.join(path, 'index.bin'), 'ab') if mode == 'a' else None
+        self._crops = None
+        if self.context and mode == 'a':
+            # drop crops of a frame whose record a crash kept from being written
+            crops = os.path.join(path, 'crops.bin')
+            keep = np.count_nonzero(self.crop_records()['frame'] < len(self))
+            os.truncate(crops, keep*CROP_RECORD.itemsize)
+            self._crops = open(crops, 'ab')
+        self._refs = None
+        self._keys = {}     # row: [keyframe index, keyframe or None, frames]
+        self._cached = None # (index, frame) of the last keyframe read
+        if self.keyframes and mode == 'a':
+            refs = os.path.join(path, 'refs.bin')
+            os.truncate(refs, len(self)*REF.itemsize)
+            for i, (row, ref) in enumerate(zip(self.records()['row'], self.references())):
+                if ref < 0:
+                    self._keys[row] = [i, None, 1]
+                else:
+                    self._keys[row][2] += 1
+            self._refs = open(refs, 'ab')
+
+    @classmethod
+    def create(cls, path, shape, dtype, codec='zlib', level=6, context=None,
+               keyframes=None):
+        """Creates an empty container and opens it for appending
+
+        A region container is created if context, the binning of its
+        context frames, is given, and a time-lapse container if
+        keyframes, the frames per keyframe of a row, is given.
+        """
+        if keyframes and codec.startswith('packed12'):
+            # differences wrap around in 16 bits
+            raise ValueError("time-lapse frames cannot be packed to 12 bits")
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump(dict(shape=list(shape), dtype=np.dtype(dtype).str,
+                           codec=codec, level=level, context=context,
+                           keyframes=keyframes), f)
+        for name in ('frames.bin', 'index.bin', 'crops.bin', 'refs.bin'):
+            open(os.path.join(path, name), 'wb').close()
+        return cls(path, 'a')
+
+    def __len__(self):
+        return os.path.getsize(os.path.join(self.path, 'index.bin')) // FRAME_RECORD.itemsize
+
+    def records(self):
+        """Returns the metadata records of all frames"""
+        return np.fromfile(os.path.join(self.path, 'index.bin'), FRAME_RECORD)
+
+    def append(self, frame, chunk=None, **meta):
+        """Appends a frame and its metadata, returns the frame index
+
+        meta holds FRAME_RECORD fields. An already encoded chunk of the
+        frame can be passed to skip compressing it here.
+        """
+        if chunk is None:
+            chunk = self._encode(frame, self.level)
+        record = np.zeros(1, FRAME_RECORD)
+        for name, value in meta.items():
+            record[name] = value
+        with self._lock:
+            self._data.seek(0, 2)
+            record['offset'] = self._data.tell()
+            record['nbytes'] = len(chunk)
+            self._data.write(chunk)
+            self._data.flush()
+            record['write_time'] = time.time()
+            self._index.write(record.tobytes())
+            self._index.flush()
+            return self._index.tell() // FRAME_RECORD.itemsize - 1
+
+    def append_regions(self, context, crops, **meta):
+        """Appends a frame as from split_regions, returns the frame index
+
+        Crops are written before the frame record, so a frame that is
+        in the index always has all its crops.
+        """
+        chunks = [self._encode(crop, self.level) for _, crop in crops]
+        chunk = self._encode(context, self.level)
+        records = np.zeros(len(crops), CROP_RECORD)
+        with self._lock:
+            self._data.seek(0, 2)
+            records['frame'] = self._index.tell() // FRAME_RECORD.itemsize
+            for record, ((y, x), crop), data in zip(records, crops, chunks):
+                record['y'], record['x'] = y, x
+                record['height'], record['width'] = crop.shape
+                record['offset'] = self._data.tell()
+                record['nbytes'] = len(data)
+                self._data.write(data)
+            self._data.flush()
+            self._crops.write(records.tobytes())
+            self._crops.flush()
+            return self.append(context, chunk, **meta)
+
+    def append_timed(self, frame, **meta):
+        """Appends a frame of a time-lapse container, returns its index
+
+        meta must hold the frame's row. The frame is stored whole if it
+        is a keyframe, else as its difference from the row's keyframe.
+        """
+        row = meta['row']
+        with self._lock:
+            key = self._keys.get(row)
+            if key is None or key[2] >= self.keyframes:
+                ref, data = -1, frame
+            else:
+                if key[1] is None:
+                    key[1] = self._read_key(key[0])
+                # unsigned wrap-around keeps the difference lossless
+                ref, data = key[0], np.subtract(frame, key[1]).astype(self.dtype, copy=False)
+            self._refs.write(np.array(ref, REF).tobytes())
+            self._refs.flush()
+            index = self.append(data, **meta)
+            if ref < 0:
+                self._keys[row] = [index, np.array(frame, self.dtype), 1]
+            else:
+                key[2] += 1
+            return index
+
+    def references(self):
+        """Returns the keyframe index of every frame of a time-lapse container"""
+        return np.fromfile(os.path.join(self.path, 'refs.bin'), REF, len(self))
+
+    def sync(self):
+        """Forces the appended frames and records to disk"""
+        with self._lock:
+            os.fsync(self._data.fileno())
+            os.fsync(self._index.fileno())
+            if self._crops is not None:
+                os.fsync(self._crops.fileno())
+            if self._refs is not None:
+                os.fsync(self._refs.fileno())
+
+    def crop_records(self):
+        """Returns the crop index of a region container"""
+        path = os.path.join(self.path, 'crops.bin')
+        count = os.path.getsize(path) // CROP_RECORD.itemsize
+        return np.fromfile(path, CROP_RECORD, count)
+
+    def read(self, i):
+        """Returns frame i, put back together in a region container"""
+        with open(os.path.join(self.path, 'index.bin'), 'rb') as f:
+            f.seek(i*FRAME_RECORD.itemsize)
+            record = np.frombuffer(f.read(FRAME_RECORD.itemsize), FRAME_RECORD)[0]
+        if self.keyframes:
+            with open(os.path.join(self.path, 'refs.bin'), 'rb') as f:
+                f.seek(i*REF.itemsize)
+                ref = int(np.frombuffer(f.read(REF.itemsize), REF)[0])
+            frame = self._decode(self._chunk(record), self.shape, self.dtype)
+            if ref < 0:
+                return frame
+            return np.add(self._read_key(ref), frame).astype(self.dtype, copy=False)
+        if not self.context:
+            return self._decode(self._chunk(record), self.shape, self.dtype)
+        shape = tuple(n // self.context for n in self.shape)
+        context = self._decode(self._chunk(record), shape, self.dtype)
+        return reconstruct(context, self.crops(i), self.shape, self.context)
+
+    def crops(self, i):
+        """Returns the ((y, x), array) crops of frame i"""
+        records = self.crop_records()
+        return [((int(r['y']), int(r['x'])),
+                 self._decode(self._chunk(r), (int(r['height']), int(r['width'])), self.dtype))
+                for r in records[records['frame'] == i]]
+
+    def _read_key(self, i):
+        """Returns keyframe i, kept until another keyframe is read"""
+        with self._lock:
+            if self._cached is None or self._cached[0] != i:
+                with open(os.path.join(self.path, 'index.bin'), 'rb') as f:
+                    f.seek(i*FRAME_RECORD.itemsize)
+                    record = np.frombuffer(f.read(FRAME_RECORD.itemsize), FRAME_RECORD)[0]
+                self._cached = (i, self._decode(self._chunk(record), self.shape, self.dtype))
+            return self._cached[1]
+
+    def _chunk(self, record):
+        with self._lock:
+            self._data.seek(int(record['offset']))
+            return self._data.read(int(record['nbytes']))
+
+    def close(self):
+        """Closes the container files"""
+        self._data.close()
+        if self._index is not None:
+            self._index.close()
+        if self._crops is not None:
+            self._crops.close()
+        if self._refs is not None:
+            self._refs.close()
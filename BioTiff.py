@@ -0,0 +1,278 @@
+"""Plain TIFF files written and read with NumPy
+
+Grayscale 8 and 16 bit images are written uncompressed, one strip per
+page, straight from the array buffer. 16 bit images holding 12 bit
+samples can be written packed, two samples to three bytes, to save a
+quarter of the space. Files can hold several pages and use the BigTIFF
+layout when they outgrow 4 GB. Nothing here touches the camera, so
+images can be saved from any thread or without a camera.
+"""
+import struct
+import sys
+
+import numpy as np
+
+# TIFF field types
+ASCII = 2
+SHORT = 3
+LONG = 4
+LONG8 = 16
+
+# classic TIFF offsets are 32 bit
+CLASSIC_LIMIT = 2**32 - 2**25
+
+
+def pack12(image):
+    """Packs a 2D array of 12 bit samples into rows of bytes
+
+    Two samples go into three bytes, most significant bits first, and
+    each row starts on a new byte: the layout of 12 bit TIFF pages.
+    Bits above the lowest 12 are dropped.
+    """
+    height, width = image.shape
+    if width % 2:
+        image = np.pad(image, ((0, 0), (0, 1)))
+    a = image[:, 0::2].astype(np.uint16)
+    b = image[:, 1::2].astype(np.uint16)
+    packed = np.empty((height, a.shape[1], 3), np.uint8)
+    packed[..., 0] = a >> 4
+    packed[..., 1] = ((a & 0xF) << 4) | ((b >> 8) & 0xF)
+    packed[..., 2] = b & 0xFF
+    packed = packed.reshape(height, -1)
+    if width % 2:
+        # the padding sample's last byte is not part of the row
+        packed = np.ascontiguousarray(packed[:, :(3*width + 1)//2])
+    return packed
+
+
+def unpack12(packed, width, out=None):
+    """Returns the uint16 image of rows packed by pack12
+
+    The samples are unpacked into out if given.
+    """
+    height = packed.shape[0]
+    pairs = (width + 1) // 2
+    packed = packed.reshape(height, -1)
+    if packed.shape[1] < 3*pairs:
+        packed = np.pad(packed, ((0, 0), (0, 3*pairs - packed.shape[1])))
+    p = packed[:, :3*pairs].reshape(height, pairs, 3).astype(np.uint16)
+    if out is None:
+        out = np.empty((height, width), np.uint16)
+    out[:, 0::2] = (p[:, :(width + 1)//2, 0] << 4) | (p[:, :(width + 1)//2, 1] >> 4)
+    out[:, 1::2] = ((p[:, :width//2, 1] & 0xF) << 8) | p[:, :width//2, 2]
+    return out
+
+
+class TiffWriter():
+    """ Writes grayscale images to a TIFF file page by page
+
+    Each page is written as the raw image bytes followed by its IFD,
+    so nothing has to be known in advance about later pages. All pages
+    use the byte order of the first image.
+
+    Attributes:
+        path: the file written
+        bigtiff: whether the file uses 64 bit offsets
+        byteorder: '<' or '>'
+    """
+    def __init__(self, path, bigtiff=False, description=None):
+        self.path = path
+        self.bigtiff = bigtiff
+        self.byteorder = None
+        self.description = description
+        self._file = open(path, 'wb')
+        self._next = None   # file offset of the last "next IFD" pointer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, image, bits=None):
+        """Appends an image as a new page
+
+        With bits=12 a 16 bit image is written packed by pack12.
+        """
+        if image.ndim != 2 or image.dtype.kind not in 'ui' or image.dtype.itemsize > 2:
+            raise ValueError("only 8 and 16 bit grayscale images are supported")
+        if bits not in (None, 12, 8*image.dtype.itemsize) or (bits == 12 and image.dtype.itemsize != 2):
+            raise ValueError("only 16 bit images can be packed to 12 bits")
+        if self.byteorder is None:
+            self._start(image.dtype)
+        height, width = image.shape
+        if bits == 12:
+            data = pack12(image)
+        else:
+            bits = 8*image.dtype.itemsize
+            if image.dtype.itemsize > 1 and self._order(image.dtype) != self.byteorder:
+                image = image.astype(image.dtype.newbyteorder(self.byteorder))
+            # a view of the image buffer, no copy is made
+            data = np.ascontiguousarray(image).reshape(-1).view(np.uint8)
+
+        f = self._file
+        offset = f.tell()
+        f.write(data)
+        tags = [
+            (256, LONG, [width]),
+            (257, LONG, [height]),
+            (258, SHORT, [bits]),
+            (259, SHORT, [1]),                  # no compression
+            (262, SHORT, [1]),                  # black is zero
+            (273, LONG8 if self.bigtiff else LONG, [offset]),
+            (277, SHORT, [1]),
+            (278, LONG, [height]),
+            (279, LONG8 if self.bigtiff else LONG, [data.nbytes]),
+            (339, SHORT, [1 if image.dtype.kind == 'u' else 2]),
+        ]
+        if self.description is not None:
+            tags.insert(5, (270, ASCII, self.description.encode('ascii') + b'\0'))
+            self.description = None     # first page only
+        self._write_ifd(tags)
+
+    def close(self):
+        """Closes the file"""
+        if self._file is not None:
+            if self.byteorder is None:
+                self._start(np.dtype('u1'))
+            self._file.close()
+            self._file = None
+
+    def _order(self, dtype):
+        """Returns the byte order of a dtype as '<' or '>'"""
+        if dtype.byteorder in ('=', '|'):
+            return '<' if sys.byteorder == 'little' else '>'
+        return dtype.byteorder
+
+    def _start(self, dtype):
+        """Writes the file header"""
+        self.byteorder = self._order(dtype)
+        mark = b'II' if self.byteorder == '<' else b'MM'
+        if self.bigtiff:
+            self._file.write(mark + self._pack('HHHQ', 43, 8, 0, 0))
+            self._next = 8
+        else:
+            self._file.write(mark + self._pack('HI', 42, 0))
+            self._next = 4
+
+    def _pack(self, fmt, *values):
+        return struct.pack(self.byteorder + fmt, *values)
+
+    def _write_ifd(self, tags):
+        """Writes an IFD after the page data and links it to the last one"""
+        f = self._file
+        valuesize = 8 if self.bigtiff else 4
+        # values that do not fit in an entry go before the IFD
+        entries = []
+        for tag, ftype, values in tags:
+            if ftype == ASCII:
+                data, count = values, len(values)
+            else:
+                code = {SHORT: 'H', LONG: 'I', LONG8: 'Q'}[ftype]
+                if ftype == LONG and not self.bigtiff and max(values) >= 2**32:
+                    raise ValueError("file too large for classic TIFF, use bigtiff")
+                data, count = self._pack('%d%s' % (len(values), code), *values), len(values)
+            if len(data) > valuesize:
+                if f.tell() % 2:
+                    f.write(b'\0')
+                entries.append((tag, ftype, count, self._pack('Q' if self.bigtiff else 'I', f.tell())))
+                f.write(data)
+            else:
+                entries.append((tag, ftype, count, data.ljust(valuesize, b'\0')))
+        if f.tell() % 2:
+            f.write(b'\0')
+        ifd = f.tell()
+        if not self.bigtiff and ifd >= 2**32:
+            raise ValueError("file too large for classic TIFF, use bigtiff")
+        if self.bigtiff:
+            f.write(self._pack('Q', len(entries)))
+            for tag, ftype, count, value in entries:
+                f.write(self._pack('HHQ', tag, ftype, count) + value)
+        else:
+            f.write(self._pack('H', len(entries)))
+            for tag, ftype, count, value in entries:
+                f.write(self._pack('HHI', tag, ftype, count) + value)
+        end = f.tell()
+        f.write(bytes(valuesize))       # no next IFD yet
+        f.seek(self._next)
+        f.write(self._pack('Q' if self.bigtiff else 'I', ifd))
+        f.seek(0, 2)
+        self._next = end
+
+
+def imwrite(path, data, bigtiff=None, description=None, bits=None):
+    """Writes a 2D image, or a 3D stack as one page per image, to path
+
+    BigTIFF is used when bigtiff is set, or by default when the data
+    would not fit in a classic TIFF. bits=12 packs 16 bit images.
+    """
+    if bigtiff is None:
+        bigtiff = data.nbytes > CLASSIC_LIMIT
+    with TiffWriter(path, bigtiff, description) as tif:
+        if data.ndim == 2:
+            tif.write(data, bits)
+        else:
+            for image in data:
+                tif.write(image, bits)
+
+
+def imread(path, page=0):
+    """Returns a page of an uncompressed grayscale TIFF as a read-only memmap
+
+    Pages of packed 12 bit samples are unpacked into a new uint16 array.
+    """
+    with open(path, 'rb') as f:
+        order = {b'II': '<', b'MM': '>'}[f.read(2)]
+
+        def unpack(fmt, size):
+            return struct.unpack(order + fmt, f.read(size))
+
+        version, = unpack('H', 2)
+        bigtiff = version == 43
+        if bigtiff:
+            unpack('HH', 4)
+            ifd, = unpack('Q', 8)
+        else:
+            ifd, = unpack('I', 4)
+        for i in range(page + 1):
+            if not ifd:
+                raise IndexError("page %d not in file" % page)
+            f.seek(ifd)
+            count, = unpack('Q', 8) if bigtiff else unpack('H', 2)
+            tags = {}
+            for j in range(count):
+                if bigtiff:
+                    tag, ftype, n = unpack('HHQ', 12)
+                    raw = f.read(8)
+                else:
+                    tag, ftype, n = unpack('HHI', 8)
+                    raw = f.read(4)
+                tags[tag] = (ftype, n, raw)
+            ifd, = unpack('Q', 8) if bigtiff else unpack('I', 4)
+
+        def value(tag, default=None):
+            """Returns the first value of a tag"""
+            if tag not in tags:
+                return default
+            ftype, n, raw = tags[tag]
+            code = {SHORT: 'H', LONG: 'I', LONG8: 'Q'}[ftype]
+            size = struct.calcsize(code)
+            if n*size > len(raw):
+                # raw holds the offset of the values
+                f.seek(struct.unpack(order + ('Q' if bigtiff else 'I'), raw)[0])
+                raw = f.read(size)
+            return struct.unpack(order + code, raw[:size])[0]
+
+        if value(259, 1) != 1 or value(277, 1) != 1:
+            raise ValueError("only uncompressed grayscale TIFF is supported")
+        width, height = value(256), value(257)
+        bits = value(258, 1)
+        kind = 'i' if value(339, 1) == 2 else 'u'
+        offset = value(273)
+        if value(278, height) < height and tags[273][1] > 1:
+            raise ValueError("only single strip pages are supported")
+    if bits == 12:
+        packed = np.memmap(path, np.uint8, 'r', offset, (height, (3*width + 1)//2))
+        return unpack12(packed, width)
+    dtype = np.dtype(order + kind + str(bits // 8))
+    return np.memmap(path, dtype, 'r', offset, (height, width))
@@ -1,10 +1,25 @@
 
-from time import sleep
+import os
+import threading
+from bisect import bisect_left
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import Future
+from time import sleep, perf_counter, time, strftime
 
 import numpy as np
 
 from Phidget22.Devices.Stepper import Stepper
-from lucam import Lucam
+from lucam import Lucam, ndarray
+from BioTiff import imwrite
+from BioStorage import (FrameWriter, ScanStack, ScanContainer, Compressor, sync,
+                        pyramid_path, write_pyramid, split_regions, reconstruct,
+                        bin_image)
+from BioAnalysis import (find_regions, measure_samples, ScanAnalyzer, result_table,
+                         GridTracker)
+from BioFrames import FramePool, StreamingCapture
+from BioScan import ScanJournal, ScanPlan
+from BioCatalog import ScanCatalog
 
 class Biosensor():
     """ Unites the camera and stepper motor in one class
@@ -16,13 +31,48 @@ class Biosensor():
         stepper: the stepper object
         camera: the camera object
         image: current image displayed
+        session: the fast frames session while a scan is running
+        plan: the ScanPlan of the latest scan
+        catalog: the ScanCatalog recording every scan and frame
+        hdr: whether frames are captured as raw 16 bit data
+        depth: significant bits per sample in captured frames
+        pyramids: whether a pyramid and thumbnail are saved with each row
+        roi_pad: pixels kept around each sample region in 'roi' storage
+        roi_context: binning of the context frame in 'roi' storage
+        analyze: whether rows are measured with interpret_image during scans
+        grid: GridTracker locating the sample spots, or None for even cells
+        results: (rows, width) sample results of the latest scan, NaN
+            for rows not measured
+        fsync: when scan writes are forced to disk, 'never', 'batch' or 'always'
+        serpentine: whether a repeated scan goes back over the rows
+        adaptive_settle: wait for the image to settle instead of sleeping
+        settle_time: seconds to wait after a move, the ceiling when adaptive
+        settle_tolerance: mean change in 8 bit grey levels of the binned
+            preview counted as settled, scaled up for deeper frames
     """
 
     def __init__(self):
         """Initializes class and sets stepper values"""
         self.stepper = BioStepper()
         self.camera = BioCam(1)
+        self.session = None
+        self.plan = None
+        os.makedirs('pics', exist_ok=True)
+        self.catalog = ScanCatalog('pics\\catalog.db')
+        self.fsync = 'never'
+        self.serpentine = True
+        self.hdr = False
+        self.depth = 8
+        self.pyramids = True
+        self.roi_pad = 16
+        self.roi_context = 8
+        self.analyze = True
+        self.grid = GridTracker()
+        self.results = None
         self.image = self.take_picture()
+        self.adaptive_settle = False
+        self.settle_time = .5
+        self.settle_tolerance = 1.0
         # Connect to stepper motor
         self.stepper.openWaitForAttachment(5000)
 
@@ -34,29 +84,543 @@ class Biosensor():
         sleep(.5)
 
     def take_picture(self):
-        """Uses camera to take picture and return image"""
+        """Uses camera to take picture and return image
+
+        During a scan the image is a pooled buffer that must be
+        released to camera.pool once it is no longer needed.
+        """
+        if self.session is not None:
+            return self.session.take()
         return self.camera.TakeSnapshot()
 
+    def set_hdr(self, enabled):
+        """Switches between 8 bit and raw 16 bit capture
+
+        In 16 bit mode the camera delivers its full pixel depth,
+        GetTruePixelDepth bits, in the low bits of each sample.
+        """
+        frameformat, framerate = self.camera.GetFormat()
+        frameformat.pixelFormat = Lucam.PIXEL_FORMAT['16' if enabled else '8']
+        self.camera.SetFormat(frameformat, framerate)
+        self.hdr = enabled
+        self.depth = self.camera.GetTruePixelDepth() if enabled else 8
+
+    def packed(self):
+        """Returns whether 16 bit frames are saved packed to 12 bits"""
+        return self.hdr and self.depth <= 12
+
     def save_image(self, image, filename):
-        """Saves an image as specified filename"""
-        self.camera.SaveImage(image,filename)
-
-    def take_scan(self, width, rows, spacing):
-        """Performs a scan and saves images"""
-        for i in range(rows):
-            #Take picture
-            print("Taking picture %d at position %d um"% (i+1,self.stepper.pos))
-            image = self.take_picture()
-            sleep(.5)
-            #Save
-            self.save_image(image,'pics\\test%d.tif'% (i+1))
-            #Move
-            self.stepper.move(spacing)
-            sleep(.5)
+        """Saves an image as specified filename
+
+        TIFF files are written with BioTiff, which is safe to call from
+        any thread; 16 bit frames of 12 bit samples are packed. Other
+        formats go through the camera driver.
+        """
+        if filename.lower().endswith(('.tif', '.tiff')):
+            packed = self.packed() and image.dtype.itemsize == 2
+            imwrite(filename, image, bits=12 if packed else None)
+        else:
+            self.camera.SaveImage(image,filename)
+
+    def new_scan_dir(self):
+        """Creates and returns a timestamped directory for a new scan"""
+        base = 'pics\\' + strftime('%Y%m%d-%H%M%S')
+        directory, n = base, 1
+        while os.path.exists(directory):
+            n += 1
+            directory = '%s-%d' % (base, n)
+        os.makedirs(directory)
+        return directory
+
+    def take_scan(self, width, rows, spacing, pipelined=False, storage='tiff',
+                  codec=None, level=6, sample_id=None):
+        """Performs a scan and saves images
+
+        If pipelined is set, each image is saved on a background thread
+        while the stage moves on to the next row. Saved rows are recorded
+        in the journal file so an interrupted scan can be resumed.
+
+        Every scan saves to its own timestamped directory under pics and
+        is entered in the catalog, frame by frame, tagged with sample_id.
+        storage is 'tiff' for a TIFF per row, 'stack' to capture all rows
+        straight into one ScanStack, or 'container' to compress them into
+        a ScanContainer along with their stage position, exposure, gain
+        and capture time. 'roi' stores only padded crops of the sample
+        regions found in each frame, plus the frame binned roi_context
+        times for context, in a region ScanContainer; it saves no
+        pyramids. Container frames are compressed with codec at
+        level in a pool of worker processes, by default 'zlib', or
+        'packed12-zlib' for 12 bit samples in 16 bit mode. A stack keeps
+        16 bit frames unpacked, as they are captured in place.
+
+        The rows start at the current position, except that in serpentine
+        mode repeating a scan from where the last one ended goes back
+        over the same rows in reverse, saving the return trip.
+        """
+        if rows < 1:
+            print("No rows to scan")
+            return
+        plan = ScanPlan(self.stepper.pos, spacing, rows, self.stepper.SCALE)
+        last = self.plan
+        if (self.serpentine and last is not None
+                and (last.spacing, last.rows) == (spacing, rows)
+                and self.stepper.pos == last.end()):
+            plan = last.reversed()
+        self.plan = plan
+        directory = self.new_scan_dir()
+        stack = container = None
+        if storage != 'tiff':
+            frame = self.camera.frame_buffer(self.camera.default_snapshot().format)
+        if storage == 'stack':
+            stack = os.path.join(directory, 'scan.stack')
+            ScanStack.create(stack, rows, frame.shape, frame.dtype)
+        elif storage in ('container', 'roi'):
+            if codec is None:
+                codec = 'packed12-zlib' if self.packed() else 'zlib'
+            container = os.path.join(directory, 'frames')
+            context = self.roi_context if storage == 'roi' else None
+            ScanContainer.create(container, frame.shape, frame.dtype, codec, level,
+                                 context).close()
+        scan_id = self.catalog.begin_scan(width, rows, spacing, plan.start,
+                                          directory, storage, sample_id)
+        journal = ScanJournal.create(os.path.join(directory, 'scan.journal'),
+                                     width, plan, stack, container,
+                                     directory, scan_id, self.hdr)
+        try:
+            self._scan(journal, pipelined)
+        finally:
+            journal.close()
+
+    def resume_scan(self, journal=None, pipelined=False):
+        """Continues an interrupted scan from its journal
+
+        Moves back to the first row that was not saved and takes only
+        the missing rows. The journal defaults to the one of the latest
+        unfinished scan in the catalog. The camera is switched back to
+        the bit depth the scan was started with. A time-lapse goes on
+        with its remaining passes after the interrupted one.
+        """
+        if journal is None:
+            scan = self.catalog.resumable_scan()
+            if scan is None:
+                print("No scan to resume")
+                return
+            journal = os.path.join(scan['directory'], 'scan.journal')
+        journal = ScanJournal.load(journal)
+        if journal.hdr != self.hdr:
+            self.set_hdr(journal.hdr)
+        if journal.passes is not None:
+            self._time_lapse(journal.width, journal.plan, journal.passes,
+                             journal.period, journal.directory, journal.container,
+                             journal.scan_id, pipelined, journal)
+            return
+        self.plan = journal.plan
+        try:
+            self._scan(journal, pipelined)
+        finally:
+            journal.close()
+
+    def _scan(self, journal, pipelined, finish=True):
+        """Takes and saves the rows of a scan that are not done yet
+
+        Each row is also measured on an analysis thread as it is taken,
+        unless analyze is off, and the results go to self.results and
+        the catalog. Once all rows are done the scan is marked finished
+        in the catalog, unless finish is False.
+        """
+        todo = journal.remaining()
+        release = self.camera.pool.release
+        compressor = None
+        # every resource is closed even if closing another one fails;
+        # callbacks run last registered first
+        with ExitStack() as cleanup:
+            if journal.stack:
+                target = ScanStack(journal.stack, 'r+')
+                save, release = self._save_slot, None
+            elif journal.container:
+                target = ScanContainer(journal.container, 'a')
+                cleanup.callback(target.close)
+                if target.context:
+                    # crops are small enough to compress on the writer thread
+                    save = self._save_regions
+                elif target.keyframes:
+                    # frames are differenced against keyframes as they are added
+                    save = self._save_timed
+                else:
+                    compressor = Compressor(target.codec, target.level)
+                    cleanup.callback(self._close_compressor, compressor)
+                    save = self._save_frame
+            else:
+                target = None
+                save = self._save_row
+            analyzer = None
+            if self.analyze:
+                analyzer = ScanAnalyzer(self.interpret_image, journal.plan.rows,
+                                        journal.width, done=release)
+                # closed after the writer, whose frames it catalogs results for
+                cleanup.callback(self._close_analyzer, analyzer, journal)
+            writer = None
+            if pipelined:
+                # closed first, it still uses the compressor and target
+                writer = FrameWriter(save, done=release, fsync=self.fsync)
+                cleanup.callback(self._close_writer, writer)
+            cleanup.callback(setattr, self, 'session', None)
+            self.session = self.camera.fast_frames()
+            with self.session:
+                if journal.stack:
+                    # frames are captured into the slots unvalidated
+                    frame = self.camera.frame_buffer(self.session.snapshot.format)
+                    if (frame.shape, frame.dtype) != (target.frames.shape[1:], target.frames.dtype):
+                        raise ValueError("camera frames %s %s do not fit stack frames %s %s"
+                                         % (frame.shape, frame.dtype, target.frames.shape[1:],
+                                            target.frames.dtype))
+                for n, i in enumerate(todo):
+                    pos = journal.plan.position(i)
+                    if self.stepper.pos != pos:
+                        self.stepper.move_to(pos)
+                        self.settle()
+                    #Take picture
+                    print("Taking picture %d at position %d um"% (i+1,self.stepper.pos))
+                    info = dict(row=i, position=pos, steps=journal.plan.targets[i],
+                                exposure=self.session.snapshot.exposure,
+                                gain=self.session.snapshot.gain, capture_time=time())
+                    if journal.stack:
+                        image = self.session.take(target.frames[i])
+                    else:
+                        image = self.take_picture()
+                    if compressor:
+                        # compress in parallel, the save waits for it
+                        info['chunk'] = compressor.submit(image)
+                    if analyzer:
+                        if release:
+                            # the analyzer releases its own reference
+                            self.camera.pool.retain(image)
+                        analyzer.submit(image, i)
+                    #Save
+                    where = target
+                    if where is None:
+                        where = os.path.join(journal.directory, 'test%d.tif'% (i+1))
+                    if writer:
+                        writer.submit(image,where,journal,info)
+                    else:
+                        if not self.adaptive_settle:
+                            sleep(self.settle_time)
+                        try:
+                            saved = save(image,where,journal,info)
+                            if self.fsync != 'never':
+                                sync(saved)
+                        finally:
+                            if release:
+                                release(image)
+                    #Move on to the next row to take
+                    if n+1 < len(todo):
+                        self.stepper.move_to(journal.plan.position(todo[n+1]))
+                        self.settle()
+        if finish and journal.scan_id is not None and not journal.remaining():
+            self.catalog.finish_scan(journal.scan_id)
+
+    def _close_writer(self, writer):
+        """Closes a scan's FrameWriter and reports its stats"""
+        try:
+            writer.close()
+        finally:
+            print("Wrote %d images: latency %.0f ms mean, %.0f ms max, scan blocked %.1f s"
+                  % (writer.written, 1000*writer.mean_latency(),
+                     1000*writer.max_latency, writer.blocked))
+
+    def _close_compressor(self, compressor):
+        """Closes a scan's Compressor and reports its rates"""
+        compressor.close()
+        for codec, rate in compressor.report().items():
+            print("Compressed with %s: ratio %.2f, %.1f MB/s per worker"
+                  % (codec, rate['ratio'], rate['mbps']))
+
+    def _close_analyzer(self, analyzer, journal):
+        """Waits for a scan's ScanAnalyzer and keeps its results
+
+        The results of the rows that were saved go to the catalog, also
+        when the scan failed, so a resumed scan only adds the rest.
+        """
+        self.results = analyzer.close()
+        if journal.scan_id is not None:
+            self._catalog_results(journal, analyzer.measured)
+
+    def _catalog_results(self, journal, measured):
+        """Adds the sample results of the rows measured to the catalog"""
+        # the latest frame of each row is the one just taken, if the
+        # journal has it as saved
+        frames = {f['row']: f['frame_id'] for f in self.catalog.frames(journal.scan_id)}
+        rows = [i for i in np.flatnonzero(measured) if i in journal.done and i in frames]
+        if rows:
+            self.catalog.add_results(result_table(
+                journal.scan_id, [frames[i] for i in rows], rows, self.results[rows]))
+
+    def _save_row(self, image, filename, journal, info):
+        """Saves the image of a row and records it in the journal"""
+        self.save_image(image, filename)
+        self._save_pyramid(image, journal.directory, info['row'])
+        journal.record(info['row'], info['position'], filename)
+        self._catalog_frame(journal, info, filename)
+        return filename
+
+    def _save_slot(self, image, stack, journal, info):
+        """Marks a row captured into a stack as done and records it"""
+        stack.mark_done(info['row'])
+        self._save_pyramid(image, journal.directory, info['row'])
+        journal.record(info['row'], info['position'], stack.path, image)
+        self._catalog_frame(journal, info, stack.path, info['row'])
+
+    def _save_frame(self, image, container, journal, info):
+        """Adds the image of a row to a container and records it"""
+        chunk = info.pop('chunk').result()[0]
+        index = container.append(image, chunk, **info)
+        self._save_pyramid(image, journal.directory, info['row'])
+        journal.record(info['row'], info['position'], container.path, image, index)
+        self._catalog_frame(journal, info, container.path, index)
+        return container
+
+    def _save_regions(self, image, container, journal, info):
+        """Adds the sample regions of a row to a container and records it"""
+        boxes = find_regions(image, journal.width, self.roi_pad)
+        context, crops = split_regions(image, boxes, container.context)
+        index = container.append_regions(context, crops, **info)
+        # the journal checksums the frame as it will be read back
+        stored = reconstruct(context, crops, image.shape, container.context)
+        journal.record(info['row'], info['position'], container.path, stored, index)
+        self._catalog_frame(journal, info, container.path, index)
+        return container
+
+    def _save_timed(self, image, container, journal, info):
+        """Adds the image of a row to a time-lapse container and records it"""
+        index = container.append_timed(image, **info)
+        journal.record(info['row'], info['position'], container.path, image, index)
+        self._catalog_frame(journal, info, container.path, index)
+        return container
+
+    def _save_pyramid(self, image, directory, row):
+        """Saves the binned levels and thumbnail of a row's image
+
+        They go in a TIFF next to the scan's frames, for viewers that do
+        not need the full resolution.
+        """
+        if self.pyramids:
+            packed = self.packed() and image.dtype.itemsize == 2
+            write_pyramid(pyramid_path(directory, row), image,
+                          bits=12 if packed else None)
+
+    def _catalog_frame(self, journal, info, path, index=None):
+        """Adds a saved row to the catalog"""
+        if journal.scan_id is not None:
+            self.catalog.add_frame(journal.scan_id, info['row'], path,
+                                   info['position'], info['capture_time'], index)
+
+    def time_lapse(self, width, rows, spacing, passes, period, pipelined=True,
+                   keyframes=10, codec='zlib', level=6, sample_id=None):
+        """Scans the same rows passes times, one pass every period seconds
+
+        All passes go into one time-lapse ScanContainer, which stores a
+        new keyframe of a row every keyframes passes and only the
+        difference from it in between. Each pass has its own journal, so
+        an interrupted pass can be finished with resume_scan(). No
+        pyramids are saved.
+        """
+        start = self.stepper.pos
+        directory = self.new_scan_dir()
+        frame = self.camera.frame_buffer(self.camera.default_snapshot().format)
+        container = os.path.join(directory, 'frames')
+        ScanContainer.create(container, frame.shape, frame.dtype, codec, level,
+                             keyframes=keyframes).close()
+        scan_id = self.catalog.begin_scan(width, rows, spacing, start,
+                                          directory, 'timelapse', sample_id)
+        plan = ScanPlan(start, spacing, rows, self.stepper.SCALE)
+        self._time_lapse(width, plan, passes, period, directory, container,
+                         scan_id, pipelined)
+
+    def _time_lapse(self, width, plan, passes, period, directory, container,
+                    scan_id, pipelined, journal=None):
+        """Takes the passes of a time-lapse that are not done yet
+
+        journal is that of an interrupted pass, which is finished first,
+        or None to start from the first pass. Each pass journals which
+        pass it is, so a resumed time-lapse knows how many are left.
+        """
+        first = journal.pass_index if journal is not None else 0
+        for n in range(first, passes):
+            began = time()
+            self.plan = plan
+            if journal is None:
+                journal = ScanJournal.create(
+                    os.path.join(directory, 'scan.journal'), width, plan,
+                    container=container, directory=directory, scan_id=scan_id,
+                    hdr=self.hdr, passes=passes, period=period, pass_index=n)
+            try:
+                # the time-lapse is finished after its last pass only
+                self._scan(journal, pipelined, finish=False)
+            finally:
+                journal.close()
+            journal = None
+            if self.serpentine:
+                plan = plan.reversed()
+            wait = period - (time() - began)
+            if n+1 < passes and wait > 0:
+                sleep(wait)
+        self.catalog.finish_scan(scan_id)
+
+    def fly_scan(self, width, rows, spacing, velocity=1000, window=None,
+                 sample_id=None):
+        """Performs a scan without stopping at each row and saves images
+
+        The stage crosses all rows in one move at velocity um/s while the
+        camera takes frames. Each frame is tagged with the stage position
+        at the middle of its capture, interpolated from the stepper
+        position events, and the frames within window um of a row
+        (spacing/4 by default) are averaged into that row's image. Like
+        take_scan, the images go to a new directory and into the catalog.
+        Returns the number of frames averaged for each row.
+        """
+        if rows < 1:
+            print("No rows to scan")
+            return None
+        stepper = self.stepper
+        pool = self.camera.pool
+        if window is None:
+            window = abs(spacing) / 4
+        direction = 1 if spacing > 0 else -1
+        centers = stepper.pos + spacing*np.arange(rows)
+        # run up to speed before the first row and past the last one
+        speed = velocity*stepper.SCALE
+        runup = direction*(speed**2/(2*stepper.getAcceleration())/stepper.SCALE + window)
+        first, last = centers[0] - runup, centers[-1] + runup
+        if not (stepper.inbounds(int(round(first*stepper.SCALE)))
+                and stepper.inbounds(int(round(last*stepper.SCALE)))):
+            print("out of bounds")
+            return None
+        stepper.move_to(first)
+        directory = self.new_scan_dir()
+        # numpy integers would be stored as blobs
+        scan_id = self.catalog.begin_scan(width, rows, spacing, float(centers[0]),
+                                          directory, 'fly', sample_id)
+
+        counts = [0]*rows
+        total = None
+        dtype = None
+        row = 0
+
+        def save(image, filename, i, captured):
+            """Saves a row image and adds it to the catalog"""
+            self.save_image(image, filename)
+            self._save_pyramid(image, directory, i)
+            self.catalog.add_frame(scan_id, i, filename, float(centers[i]), captured)
+            return filename
+
+        writer = FrameWriter(save)
+
+        def add(t, frame):
+            """Adds a tagged frame to the row it belongs to"""
+            nonlocal row, total, dtype
+            pos = stepper.position_at(t)
+            # finish the rows the stage has moved past
+            while row < rows and direction*(pos - centers[row]) > window:
+                finish()
+            if row < rows and abs(pos - centers[row]) <= window:
+                if total is None:
+                    total = frame.astype(np.float64)
+                    dtype = frame.dtype
+                else:
+                    total += frame
+                counts[row] += 1
+            pool.release(frame)
+
+        def finish():
+            """Saves the average of the current row"""
+            nonlocal row, total
+            if total is None:
+                print("No pictures for row %d" % (row+1))
+            else:
+                print("Saving picture %d from %d frames" % (row+1, counts[row]))
+                image = np.rint(total / counts[row]).astype(dtype)
+                filename = os.path.join(directory, 'test%d.tif'% (row+1))
+                writer.submit(image, filename, row, time())
+            total = None
+            row += 1
+
+        limit = stepper.getVelocityLimit()
+        interval = stepper.getDataInterval()
+        stepper.setVelocityLimit(speed)
+        stepper.setDataInterval(stepper.getMinDataInterval())
+        pending = deque()
+        self.session = self.camera.fast_frames()
+        try:
+            with self.session:
+                stepper.start_tracking()
+                motion = stepper.start_move_to(last)
+                while not motion.done():
+                    start = perf_counter()
+                    frame = self.session.take()
+                    pending.append(((start + perf_counter())/2, frame))
+                    # a position is known once a later position event came in
+                    while pending and pending[0][0] <= stepper.track_time():
+                        add(*pending.popleft())
+                stepper.wait_motion(motion)
+                while pending:
+                    add(*pending.popleft())
+                while row < rows:
+                    finish()
+        finally:
+            self.session = None
+            stepper.stop_tracking()
+            stepper.setVelocityLimit(limit)
+            stepper.setDataInterval(interval)
+            for t, frame in pending:
+                pool.release(frame)
+            writer.close()
+        self.catalog.finish_scan(scan_id)
+        return counts
+
+    def settle(self):
+        """Waits for the stage to settle after a move
+
+        Sleeps for settle_time, or in adaptive mode grabs binned preview
+        frames until two in a row differ by less than settle_tolerance,
+        giving up after settle_time. Binning averages out the sensor
+        noise, which would otherwise exceed the tolerance on its own.
+        Returns the time spent waiting.
+        """
+        start = perf_counter()
+        if not self.adaptive_settle:
+            sleep(self.settle_time)
+            return perf_counter() - start
+        tolerance = self.settle_tolerance * 2**(self.depth - 8)
+        snapshot = self.camera.preview_snapshot()
+        previous = self._preview_frame(snapshot)
+        while perf_counter() - start < self.settle_time:
+            frame = self._preview_frame(snapshot)
+            if np.abs(frame - previous).mean() <= tolerance:
+                break
+            previous = frame
+        return perf_counter() - start
+
+    def _preview_frame(self, snapshot):
+        """Returns a frame binned 16 times for settle detection"""
+        if self.session is not None:
+            # still mode is unavailable while fast frames are enabled
+            frame = self.session.take()
+            preview = bin_image(frame, 16)
+            self.camera.pool.release(frame)
+            return preview
+        # the snapshot is already subsampled by 4
+        return bin_image(self.camera.TakeSnapshot(snapshot), 4)
 
     def interpret_image(self, image, width):
-        """To be added in future"""
-        pass
+        """Measures the width samples in a row image
+
+        Returns an array of BioAnalysis.SAMPLE_RESULT with the integrated
+        intensity, mean, background and SNR of each sample, left to right.
+        The spots are located by fitting a grid to them, which is kept
+        for the following rows while it still fits.
+        """
+        layout = self.grid.layout(image, width) if self.grid is not None else {}
+        return measure_samples(image, width, **layout)
 
     def stop(self):
         """Move back to home position and disengage stepper motor"""
@@ -71,13 +635,17 @@ class BioStepper(Stepper):
     """ Interfaces with the stepper motor
 
     Adds custom functions for movement of the stepper motor and 
-    internally keeps track of position.
+    internally keeps track of position. Moves complete on the Phidget
+    position change and stopped events rather than by polling, so other
+    threads keep running while the stage moves.
 
     Attributes:
         pos: the current stepper position
         SCALE: the conversion rate for steps to micrometers
         MINPOS: Minimum position
         MAXPOS: Maximum position
+        timeout: seconds to wait for a move before giving up
+        track: PositionTrack of the stage while tracking, else None
     """
     def __init__(self,pos = 0,scale = .6085):
         """Initialize variables and call Phidget initializer"""
@@ -86,44 +654,244 @@ class BioStepper(Stepper):
         self.SCALE = scale  # steps/micrometer
         self.MINPOS = -2000 # steps
         self.MAXPOS = 30000 # steps
+        self.timeout = 30   # seconds
+        self._motion = None # move in progress
+        self.track = None
+        self._lock = threading.Lock()
+        self.setOnPositionChangeHandler(self._on_position_change)
+        self.setOnStoppedHandler(self._on_stopped)
 
     def move(self, amount):
         """Move the slide left or right by an amount of micrometers."""
-        # get target, in steps
-        target = int((self.pos + amount)*self.SCALE)
-        if self.inbounds(target):
-            self.setEngaged(True)
-            self.setTargetPosition(target)
-            while self.getPosition() != target:
-                pass
-            self.setEngaged(False)
-            self.pos += amount
+        motion = self.start_move_to(self.pos + amount)
+        if motion is not None:
+            self.wait_motion(motion)
         else:
             print("out of bounds")
 
     def move_to(self, newpos):
         """Move to a new position given in micrometers"""
-        # get target in steps
-        target = int(newpos*self.SCALE)
-        if self.inbounds(target):
-            self.setEngaged(True)
-            self.setTargetPosition(target)
-            while self.getPosition() != target:
-                pass
-            self.setEngaged(False)
-            self.pos = newpos
+        motion = self.start_move_to(newpos)
+        if motion is not None:
+            self.wait_motion(motion)
         else:
             pass #idk, raise an exception or something
-        
+
+    def start_move_to(self, newpos):
+        """Start a move to a position in micrometers without waiting
+
+        Returns a Motion that completes when the stage reaches the
+        target, or None if the target is out of bounds. Starting a new
+        move cancels the one in progress.
+        """
+        # get target in steps
+        target = int(round(newpos*self.SCALE))
+        if not self.inbounds(target):
+            return None
+        motion = Motion(target, newpos)
+        with self._lock:
+            if self._motion is not None:
+                self._motion.cancel()
+            self._motion = motion
+        self.setEngaged(True)
+        self.setTargetPosition(target)
+        # No events arrive if we are already there
+        self._check_motion(self.getPosition())
+        return motion
+
+    def wait_motion(self, motion, timeout=None):
+        """Wait for a move from start_move_to and disengage the motor
+
+        Raises concurrent.futures.TimeoutError if the move takes longer
+        than timeout seconds, self.timeout by default.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        motion.result(timeout)
+        self.setEngaged(False)
+        self.pos = motion.pos
+
+    def start_tracking(self):
+        """Start recording timestamped positions from position events"""
+        self.track = PositionTrack(perf_counter(), self.getPosition())
+
+    def stop_tracking(self):
+        """Stop recording positions and return the recorded samples"""
+        track, self.track = self.track, None
+        return track
+
+    def track_time(self):
+        """Returns the perf_counter time of the latest position sample"""
+        return self.track.times[-1]
+
+    def position_at(self, t):
+        """Returns the tracked position in micrometers at perf_counter time t
+
+        Interpolated linearly between position events.
+        """
+        return self.track.position(t) / self.SCALE
+
+    def _on_position_change(self, ch, position):
+        """Phidget handler, called on the Phidget event thread"""
+        # stop_tracking may clear it on another thread
+        track = self.track
+        if track is not None:
+            track.add(perf_counter(), position)
+        self._check_motion(position)
+
+    def _on_stopped(self, ch):
+        """Phidget handler, called on the Phidget event thread"""
+        self._check_motion(self.getPosition())
+
+    def _check_motion(self, position):
+        """Complete the current move if position is its target"""
+        with self._lock:
+            motion = self._motion
+            if motion is not None and position == motion.target:
+                self._motion = None
+                if not motion.done():
+                    motion.set_result(position)
+
     def inbounds(self, position):
         """Returns whether a position is valid or not"""
         return (self.MINPOS <= position <= self.MAXPOS)
 
 
+class PositionTrack():
+    """ Timestamped stage positions recorded during a move
+
+    Samples are added on the Phidget event thread while the capture
+    thread looks up positions, in time proportional to the log of the
+    number of samples. The steps of a sample are stored before its
+    time, so a reader never sees a time without its position.
+
+    Attributes:
+        times: perf_counter time of each sample, increasing
+        steps: position of each sample in steps
+    """
+    def __init__(self, t, position):
+        self.times = [t]
+        self.steps = [position]
+
+    def add(self, t, position):
+        """Adds the position in steps at perf_counter time t"""
+        self.steps.append(position)
+        self.times.append(t)
+
+    def position(self, t):
+        """Returns the position in steps at time t
+
+        Interpolated linearly between samples, and held at the first
+        and last sample outside them.
+        """
+        times, steps = self.times, self.steps
+        n = len(times)
+        i = bisect_left(times, t, 0, n)
+        if i == 0:
+            return steps[0]
+        if i == n:
+            return steps[n-1]
+        t0, t1 = times[i-1], times[i]
+        return steps[i-1] + (steps[i] - steps[i-1])*(t - t0)/(t1 - t0)
+
+
+class Motion(Future):
+    """ A stage move in progress
+
+    Waitable with result(timeout); the result is the final position
+    in steps.
+
+    Attributes:
+        target: target position in steps
+        pos: target position in micrometers
+    """
+    def __init__(self, target, pos):
+        super().__init__()
+        self.target = target
+        self.pos = pos
+
+
 class BioCam(Lucam):
     """ Interfaces with the camera
 
-    Does nothing
+    Attributes:
+        pool: reusable frame buffers for the capture hot path
     """
     def __init__(self, number=1):
         super().__init__(number=1) #call parent init
+        self.pool = FramePool(self.frame_buffer, self.frame_key)
+
+    def fast_frames(self, snapshot=None):
+        """Returns a FastFrameSession to use as a context manager"""
+        return FastFrameSession(self, snapshot)
+
+    def stream(self, nframes=32):
+        """Returns a StreamingCapture to use as a context manager"""
+        return StreamingCapture(self, nframes)
+
+    def frame_buffer(self, frameformat):
+        """Returns an empty array for a frame of the given format"""
+        return ndarray(frameformat, self._byteorder)[0]
+
+    @staticmethod
+    def frame_key(frameformat):
+        """Returns a hashable key for the buffer shape of a frame format"""
+        return (frameformat.width // frameformat.binningX,
+                frameformat.height // frameformat.binningY,
+                frameformat.pixelFormat)
+
+    def preview_snapshot(self, subsample=4):
+        """Returns snapshot settings for a cheap subsampled frame"""
+        snapshot = self.default_snapshot()
+        frame = snapshot.format
+        # subsampled dimensions must still be multiples of 8
+        frame.width -= frame.width % (8*subsample)
+        frame.height -= frame.height % (8*subsample)
+        frame.subSampleX = subsample
+        frame.subSampleY = subsample
+        frame.flagsX = 0
+        frame.flagsY = 0
+        return snapshot
+
+
+class FastFrameSession():
+    """ Keeps the camera in fast frames mode, e.g. for a whole scan
+
+    Used as a context manager: fast frames are enabled once on entry
+    and disabled on exit, and take() captures straight into buffers
+    from the camera's frame pool.
+
+    Attributes:
+        camera: the camera object
+        snapshot: snapshot settings used for every frame
+    """
+    def __init__(self, camera, snapshot=None):
+        self.camera = camera
+        self.snapshot = snapshot
+
+    def __enter__(self):
+        if self.snapshot is None:
+            self.snapshot = self.camera.default_snapshot()
+        self.camera.EnableFastFrames(self.snapshot)
+        return self
+
+    def __exit__(self, *exc):
+        self.camera.DisableFastFrames()
+
+    def take(self, out=None):
+        """Captures a frame into a pooled buffer and returns it
+
+        The caller owns one reference to the buffer and must release it
+        to camera.pool when done. If out is given, the frame is captured
+        into it instead, e.g. a slot of a ScanStack.
+        """
+        if out is not None:
+            self.camera.TakeFastFrame(out, validate=False)
+            return out
+        out = self.camera.pool.checkout(self.snapshot.format)
+        try:
+            self.camera.TakeFastFrame(out, validate=False)
+        except Exception:
+            self.camera.pool.release(out)
+            raise
+        return out
@@ -23,4 +23,6 @@ def main():
 		biosensor.stop()
 		exit(0)
 
-main()
+# Worker processes re-import this module, they must not start the GUI
+if __name__ == '__main__':
+	main()
@@ -675,6 +675,8 @@ class Lucam(object):
         self._streaming = None  # frame format while in streaming mode
         self._callbacks = {}  # references to callback functions
         self._displaying_window = False
+        self._snapshot = None  # cached default snapshot settings
+        self._autoexposure = False  # exposure changes behind our back
 
     def __del__(self):
         """Close connection to camera."""
@@ -757,7 +759,19 @@ class Lucam(object):
         raise AttributeError("'Lucam' object has no attribute '%s'" % name)
 
     def default_snapshot(self):
-        """Return default Snapshot settings."""
+        """Return default Snapshot settings.
+
+        The settings are cached and only read from the camera again after
+        exposure, gain or frame format were changed through this object.
+        A copy is returned, which may be modified.
+
+        """
+        if self._snapshot is None or self._autoexposure:
+            self._snapshot = self._read_snapshot()
+        return API.LUCAM_SNAPSHOT.from_buffer_copy(self._snapshot)
+
+    def _read_snapshot(self):
+        """Return default Snapshot settings read from camera."""
         snapshot = API.LUCAM_SNAPSHOT()
         snapshot.format = self.GetFormat()[0]
         snapshot.exposure = self.GetProperty('exposure')[0]
@@ -792,6 +806,8 @@ class Lucam(object):
                 continue
             prop = Lucam.PROPERTY[name]
             flag = kwargs.get(name + '_flag', 0)
+            if prop in (API.LUCAM_PROP_EXPOSURE, API.LUCAM_PROP_GAIN):
+                self._snapshot = None
             if not API.LucamSetProperty(self._handle, prop, value, flag):
                 raise LucamError(self)
 
@@ -811,6 +827,7 @@ class Lucam(object):
             raise LucamError(self)
         self._fastframe = None
         self._streaming = None
+        self._snapshot = None
 
     def QueryVersion(self):
         """Return camera version information as API.LUCAM_VERSION."""
@@ -962,6 +979,8 @@ class Lucam(object):
             flags, flagseq = 0x0, flags
             for f in flagseq:
                 flags |= Lucam.PROP_FLAG[f]
+        if prop in (API.LUCAM_PROP_EXPOSURE, API.LUCAM_PROP_GAIN):
+            self._snapshot = None
         if not API.LucamSetProperty(self._handle, prop, value, flags):
             raise LucamError(self)
 
@@ -1027,6 +1046,7 @@ class Lucam(object):
         must be evenly divisible by 8.
 
         """
+        self._snapshot = None
         if not API.LucamSetFormat(self._handle, frameformat, framerate):
             raise LucamError(self)
         if self._fastframe:
@@ -1603,6 +1623,7 @@ class Lucam(object):
             Window coordinates after any subsampling or binning.
 
         """
+        self._snapshot = None
         if not API.LucamOneShotAutoExposure(self._handle, target,
                                             startx, starty, width, height):
             raise LucamError(self)
@@ -1731,11 +1752,14 @@ class Lucam(object):
                 self._handle, target, startx, starty,
                 width, height, lightingperiod):
             raise LucamError(self)
+        self._autoexposure = True
 
     def ContinuousAutoExposureDisable(self):
         """Undocumented function."""
         if not API.LucamContinuousAutoExposureDisable(self._handle):
             raise LucamError(self)
+        self._autoexposure = False
+        self._snapshot = None
 
     def LucamAutoFocusStart(self, startx, starty, width, height,
                             callback=None, context=None):